@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# Compare the bluepy notification pump against the old poll loop on a real mesh.
+#
+# For each mode the mesh is connected with measure_latency enabled, one device is
+# toggled between two brightness levels, and the time from each command until that
+# device's status notification arrives is recorded.
+#
+#   python3 benchmarks/bench_bluepy_notify.py cync_mesh.yaml <meshid> <deviceid> [--count N]
+import argparse
+import asyncio
+import json
+import sys
+import time
+from pathlib import Path
+
+import yaml
+
+sys.path.insert(0,str(Path(__file__).resolve().parent.parent/'src'))
+from acync import acync
+
+def percentiles(samples):
+    if not samples: return {}
+    ordered=sorted(samples)
+    return {'count': len(ordered),
+            'p50_ms': round(1000*ordered[len(ordered)//2],2),
+            'p95_ms': round(1000*ordered[int(len(ordered)*0.95)],2),
+            'max_ms': round(1000*ordered[-1],2)}
+
+async def run_mode(configdict, meshid, deviceid, mode, count):
+    mesh=configdict['meshconfig'][meshid]
+    mesh['usebtlib']='bluepy'
+    mesh['bluepy_notify']=mode
+    mesh['measure_latency']=True
+
+    waiting={}
+    async def callback(asyncobj, devicestatus):
+        if devicestatus.id==deviceid and 'sent' in waiting and not waiting['event'].is_set():
+            waiting['latency']=time.perf_counter()-waiting['sent']
+            waiting['event'].set()
+
+    meshes=acync(callback=callback)
+    meshes.populate_from_configdict(configdict)
+    if not await meshes.connect():
+        raise SystemExit("unable to connect to mesh")
+    device=meshes.devices[f"{mesh['mac']}/{deviceid}"]
+    device.online=True
+
+    latencies=[]
+    for i in range(count):
+        waiting['event']=asyncio.Event()
+        waiting['sent']=time.perf_counter()
+        await device.set_brightness(20 if i%2 else 80)
+        try:
+            await asyncio.wait_for(waiting['event'].wait(),5)
+            latencies.append(waiting['latency'])
+        except asyncio.TimeoutError:
+            pass
+        await asyncio.sleep(0.2)
+
+    gatt=meshes.networks[mesh['name']].client
+    result={'command_to_status': percentiles(latencies), 'lost': count-len(latencies), 'bluepy': gatt.latency.summary()}
+    await meshes.disconnect()
+    return result
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("configyaml",help="YAML config file")
+    parser.add_argument("meshid",help="mesh id (key under meshconfig)")
+    parser.add_argument("deviceid",type=int,help="device id to toggle")
+    parser.add_argument("--count",type=int,default=50,help="commands per mode")
+    args = parser.parse_args()
+
+    results={}
+    for mode in ('poll','pump'):
+        with Path(args.configyaml).open("rt") as fp:
+            configdict=yaml.safe_load(fp)
+        meshid=args.meshid
+        if meshid not in configdict['meshconfig'] and meshid.isdigit():
+            meshid=int(meshid)
+        configdict['meshconfig'][meshid].setdefault('name',f'mesh_{meshid}')
+        results[mode]=asyncio.run(run_mode(configdict,meshid,args.deviceid,mode,args.count))
+    print(json.dumps(results,indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# Cloud config download against a local stub of the Cync API, so large multi-mesh
+# accounts can be measured offline.
+#
+#   sequential       the old download: one bare requests.get (new connection) per mesh, in turn
+#   pooled           fetch_meshinfo over one keep-alive session, one request at a time
+#   concurrent       fetch_meshinfo with --workers requests in flight
+#   cache            save_meshinfo_cache + load_meshinfo_cache of the result
+#   merge            app_meshinfo_to_configdict into an existing config with local settings
+#
+#   python3 benchmarks/bench_cloud.py [--meshes 40] [--bulbs 30] [--latency 0.05] [--workers 8]
+import argparse
+import json
+import re
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+SRC=Path(__file__).resolve().parent.parent/'src'
+sys.path.insert(0,str(SRC))
+
+from acync import acync
+from acync import cloud
+
+def make_account(meshes, bulbs):
+    devices=[]
+    properties={}
+    for meshid in range(1,meshes+1):
+        devices.append({'id': 1000+meshid, 'product_id': 'stub', 'name': f'mesh {meshid}', 'mac': f'AABBCCDD{meshid:04X}', 'access_key': 100000+meshid})
+        properties[1000+meshid]={'bulbsArray': [{'deviceID': f'{1000+meshid}{id:03d}', 'displayName': f'Bulb {meshid}-{id}', 'mac': f'A4C1{meshid:04X}00{id:02X}', 'deviceType': 137}
+                                                for id in range(1,bulbs+1)]}
+    return (devices,properties)
+
+class stub_api(ThreadingHTTPServer):
+    daemon_threads=True
+
+    def __init__(self, account, latency):
+        (self.devices,self.properties)=account
+        self.latency=latency
+        self.connections=0
+        self.requests=0
+        self.lock=threading.Lock()
+        ThreadingHTTPServer.__init__(self,('127.0.0.1',0),stub_handler)
+
+class stub_handler(BaseHTTPRequestHandler):
+    protocol_version='HTTP/1.1'
+    # headers and body are separate writes - without this keep-alive responses stall on delayed ACKs
+    disable_nagle_algorithm=True
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections+=1
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        # login: any credentials are accepted
+        self.rfile.read(int(self.headers.get('Content-Length',0)))
+        self.reply({'access_token': 'token', 'user_id': 'user'} if self.path=='/v2/user_auth/two_factor' else {})
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests+=1
+        time.sleep(self.server.latency)
+        if re.fullmatch(r'/v2/user/[^/]+/subscribe/devices',self.path):
+            body=self.server.devices
+        else:
+            match=re.fullmatch(r'/v2/product/[^/]+/device/(\d+)/property',self.path)
+            if match is None or int(match.group(1)) not in self.server.properties:
+                self.send_error(404)
+                return
+            body=self.server.properties[int(match.group(1))]
+        self.reply(body)
+
+    def reply(self, body):
+        data=json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header('Content-Type','application/json')
+        self.send_header('Content-Length',str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+def timed(server, fn):
+    (server.connections,server.requests)=(0,0)
+    start=time.perf_counter()
+    result=fn()
+    return (result,{'seconds': round(time.perf_counter()-start,3), 'requests': server.requests, 'connections': server.connections})
+
+def sequential(api_url):
+    # what get_app_meshinfo did before: a new connection per request, one mesh at a time
+    mesh_networks=cloud._get_devices('token','user',None,api_url)
+    for mesh in mesh_networks:
+        mesh['properties']=cloud._get_properties('token',mesh['product_id'],mesh['id'],None,api_url)
+    return mesh_networks
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--meshes",type=int,default=40,help="meshes in the stub account")
+    parser.add_argument("--bulbs",type=int,default=30,help="bulbs per mesh")
+    parser.add_argument("--latency",type=float,default=0.05,help="seconds the stub takes per request")
+    parser.add_argument("--workers",type=int,default=8,help="concurrent property downloads")
+    args = parser.parse_args()
+
+    server=stub_api(make_account(args.meshes,args.bulbs),args.latency)
+    threading.Thread(target=server.serve_forever,daemon=True).start()
+    api_url=f'http://127.0.0.1:{server.server_address[1]}/v2'
+
+    results={'meshes': args.meshes, 'bulbs': args.bulbs, 'latency': args.latency, 'workers': args.workers}
+    (expected,results['sequential'])=timed(server,lambda: sequential(api_url))
+    (meshinfo,results['pooled'])=timed(server,lambda: cloud.fetch_meshinfo('token','user',api_url=api_url,workers=1))
+    (meshinfo,results['concurrent'])=timed(server,lambda: cloud.fetch_meshinfo('token','user',api_url=api_url,workers=args.workers))
+    assert meshinfo==expected
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cachepath=Path(tmpdir)/'cync_mesh_cloud.json'
+        start=time.perf_counter()
+        cloud.save_meshinfo_cache(cachepath,meshinfo)
+        cached=cloud.load_meshinfo_cache(cachepath,3600)
+        results['cache']={'seconds': round(time.perf_counter()-start,3), 'mode': oct(cachepath.stat().st_mode & 0o777)}
+        assert cached==meshinfo
+
+    existing=acync.app_meshinfo_to_configdict(meshinfo)
+    existing['mqtt_url']='mqtt://broker:1883/'
+    for mesh in existing['meshconfig'].values():
+        mesh['usebtlib']='bluepy'
+        for bulb in mesh['bulbs'].values():
+            bulb['priority']=1
+    start=time.perf_counter()
+    merged=acync.app_meshinfo_to_configdict(meshinfo,existing)
+    results['merge']={'seconds': round(time.perf_counter()-start,4),
+                      'kept_local': merged['mqtt_url']=='mqtt://broker:1883/' and all(mesh['usebtlib']=='bluepy' and all(bulb['priority']==1 for bulb in mesh['bulbs'].values()) for mesh in merged['meshconfig'].values())}
+
+    server.shutdown()
+    print(json.dumps({'benchmark': 'cloud', 'results': results},indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+# End-to-end latency and throughput of the bridge: MQTT command -> mesh write -> status publish.
+#
+# Starts a local amqtt broker and runs cync2mqtt.run_mqtt in-process against simulated
+# meshes (usebtlib: sim), then measures for each device count:
+#   startup_ready_s      run_mqtt start until every device was published online
+#   command_to_write     MQTT set publish -> control packet applied by the simulated mesh
+#   notify_to_publish    status notification delivered to the bridge -> MQTT status received
+#   command_to_status    MQTT set publish -> MQTT status received
+#   commands_per_s       sustained rate for a burst of commands to distinct devices
+# Results are printed as JSON.
+#
+#   python3 benchmarks/bench_e2e.py [--devices 10 100 500] [--commands 200] [--rate 50]
+import argparse
+import asyncio
+import importlib.machinery
+import importlib.util
+import json
+import logging
+import sys
+import time
+from pathlib import Path
+
+from amqtt.broker import Broker
+from amqtt.client import MQTTClient
+from amqtt.mqtt.constants import QOS_0
+
+SRC=Path(__file__).resolve().parent.parent/'src'
+sys.path.insert(0,str(SRC))
+
+def load_cync2mqtt():
+    loader=importlib.machinery.SourceFileLoader('cync2mqtt_script',str(SRC/'cync2mqtt'))
+    spec=importlib.util.spec_from_loader(loader.name,loader)
+    module=importlib.util.module_from_spec(spec)
+    loader.exec_module(module)
+    return module
+
+def percentiles(samples):
+    if not samples: return {}
+    ordered=sorted(samples)
+    return {'count': len(ordered),
+            'p50_ms': round(1000*ordered[len(ordered)//2],2),
+            'p95_ms': round(1000*ordered[int(len(ordered)*0.95)],2),
+            'p99_ms': round(1000*ordered[int(len(ordered)*0.99)],2),
+            'max_ms': round(1000*ordered[-1],2)}
+
+def make_config(count, port, rate, simoptions):
+    # device ids are one byte on the mesh, so large counts are spread over several meshes
+    meshconfig={}
+    meshid=0
+    while count>0:
+        meshid+=1
+        size=min(count,250)
+        count-=size
+        bulbs={id: {'mac': f'A4:C1:{meshid:02X}:00:00:{id:02X}', 'name': f'bulb_{meshid}_{id}'} for id in range(1,size+1)}
+        meshconfig[meshid]={'mac': f'AABBCCDD00{meshid:02X}', 'access_key': 100000+meshid, 'usebtlib': 'sim',
+                            'command_rate': rate, 'connect_race': 1, 'bulbs': bulbs, 'sim': dict(simoptions)}
+    return {'mqtt_url': f'mqtt://127.0.0.1:{port}/', 'status_deadline': 5, 'meshconfig': meshconfig}
+
+class observer(object):
+    # MQTT client watching the bridge's status and availability topics
+    def __init__(self, topic):
+        self.topic=topic
+        self.online=set()
+        self.waiters={}
+
+    async def start(self, url):
+        self.client=MQTTClient()
+        await self.client.connect(url)
+        await self.client.subscribe([(f'{self.topic}/status/#',QOS_0),(f'{self.topic}/availability/#',QOS_0)])
+        self.task=asyncio.create_task(self.run())
+
+    async def run(self):
+        while True:
+            message=await self.client.deliver_message()
+            now=time.perf_counter()
+            parts=message.topic.split('/')
+            devicename='/'.join(parts[2:])
+            if parts[1]=='availability':
+                if message.data==b'online':
+                    self.online.add(devicename)
+                else:
+                    self.online.discard(devicename)
+            elif parts[1]=='status' and message.data.startswith(b'{'):
+                brightness=json.loads(message.data)['brightness']
+                waiter=self.waiters.pop((devicename,brightness),None)
+                if waiter is not None and not waiter.done():
+                    waiter.set_result(now)
+
+    def expect(self, devicename, brightness):
+        future=asyncio.get_running_loop().create_future()
+        self.waiters[(devicename,brightness)]=future
+        return future
+
+    async def stop(self):
+        self.task.cancel()
+        await asyncio.gather(self.task,return_exceptions=True)
+        await self.client.disconnect()
+
+async def run_bench(cync2mqtt, count, commands, rate, port, simoptions):
+    configdict=make_config(count,port,rate,simoptions)
+    devicenames=[f"{mesh['mac']}/{id}" for mesh in configdict['meshconfig'].values() for id in mesh['bulbs']]
+
+    broker=Broker({'listeners': {'default': {'type': 'tcp', 'bind': f'127.0.0.1:{port}'}}, 'sys_interval': 0,
+                   'auth': {'allow-anonymous': True, 'plugins': ['auth_anonymous']}, 'topic-check': {'enabled': False}})
+    await broker.start()
+    watcher=observer('acyncmqtt')
+    await watcher.start(configdict['mqtt_url'])
+    publisher=MQTTClient()
+    await publisher.connect(configdict['mqtt_url'])
+
+    bridge=cync2mqtt.cync2mqtt(configdict)
+    start=time.perf_counter()
+    bridgetask=asyncio.create_task(bridge.run_mqtt())
+    while len(watcher.online)<len(devicenames):
+        await asyncio.sleep(0.01)
+        if bridgetask.done():
+            raise SystemExit("bridge exited during startup")
+    ready=time.perf_counter()-start
+
+    # timestamps from inside the simulated meshes
+    writes={}
+    notifies={}
+    for mesh in bridge.meshnetworks.simmeshes.values():
+        def on_command(target, command, data, meshmac=mesh.name):
+            if command==0xd2:
+                writes[(f'{meshmac}/{target}',data[0])]=time.perf_counter()
+        def on_notify(packet, meshmac=mesh.name):
+            now=time.perf_counter()
+            for i in (10,14):
+                if packet[i+1]:
+                    notifies.setdefault((f'{meshmac}/{packet[i]}',packet[i+2] & 0x7f),now)
+        mesh.on_command=on_command
+        mesh.on_notify=on_notify
+
+    # latency: one command at a time
+    command_to_write=[]
+    notify_to_publish=[]
+    command_to_status=[]
+    for i in range(commands):
+        devicename=devicenames[i%len(devicenames)]
+        brightness=10+(i%80)
+        notifies.pop((devicename,brightness),None)
+        waiter=watcher.expect(devicename,brightness)
+        sent=time.perf_counter()
+        await publisher.publish(f'acyncmqtt/set/{devicename}',json.dumps({'state': 'ON', 'brightness': brightness}).encode(),qos=QOS_0)
+        try:
+            received=await asyncio.wait_for(waiter,5)
+        except asyncio.TimeoutError:
+            continue
+        command_to_status.append(received-sent)
+        if (devicename,brightness) in writes:
+            command_to_write.append(writes[(devicename,brightness)]-sent)
+        if (devicename,brightness) in notifies:
+            notify_to_publish.append(received-notifies[(devicename,brightness)])
+
+    # throughput: a burst of commands to distinct devices
+    burst=devicenames[0:commands] if commands<=len(devicenames) else devicenames
+    writes.clear()
+    brightness=95
+    sent=time.perf_counter()
+    for devicename in burst:
+        await publisher.publish(f'acyncmqtt/set/{devicename}',json.dumps({'state': 'ON', 'brightness': brightness}).encode(),qos=QOS_0)
+    deadline=time.perf_counter()+max(30,2*len(burst)/rate)
+    while len([key for key in writes if key[1]==brightness])<len(burst) and time.perf_counter()<deadline:
+        await asyncio.sleep(0.01)
+    done=[writes[key] for key in writes if key[1]==brightness]
+    throughput=len(done)/(max(done)-sent) if done else 0
+
+    bridgetask.cancel()
+    await asyncio.gather(bridgetask,return_exceptions=True)
+    for mesh in bridge.meshnetworks.simmeshes.values():
+        mesh.close()
+    await publisher.disconnect()
+    await watcher.stop()
+    await broker.shutdown()
+
+    return {'devices': count,
+            'startup_ready_s': round(ready,3),
+            'command_to_write': percentiles(command_to_write),
+            'notify_to_publish': percentiles(notify_to_publish),
+            'command_to_status': percentiles(command_to_status),
+            'commands_per_s': round(throughput,1),
+            'burst': len(burst),
+            'burst_written': len(done)}
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--devices",type=int,nargs='+',default=[10,100,500],help="device counts to run")
+    parser.add_argument("--commands",type=int,default=200,help="commands per latency/throughput phase")
+    parser.add_argument("--rate",type=float,default=50,help="command_rate (packets/sec) per mesh")
+    parser.add_argument("--latency",type=float,default=0.02,help="simulated notification latency (s)")
+    parser.add_argument("--loss",type=float,default=0.0,help="simulated notification loss probability")
+    parser.add_argument("--port",type=int,default=18839,help="local broker port")
+    parser.add_argument("--log-level",default='WARNING',help='bridge log level')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    for logname in ('cync2mqtt','acync'):
+        logging.getLogger(logname).setLevel(args.log_level.upper())
+    for logname in ('amqtt','transitions'):
+        logging.getLogger(logname).setLevel(logging.ERROR)
+
+    cync2mqtt=load_cync2mqtt()
+    results=[]
+    for count in args.devices:
+        results.append(asyncio.run(run_bench(cync2mqtt,count,args.commands,args.rate,args.port,{'latency': args.latency, 'loss': args.loss})))
+    print(json.dumps({'benchmark': 'e2e', 'rate': args.rate, 'results': results},indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# Fixed versus adaptive packet pacing on simulated meshes (no mqtt).  A burst of
+# brightness commands, one per device, goes through the command scheduler.
+#
+#   healthy      the mesh relays a control packet in --airtime seconds
+#   congested    the mesh needs 10x as long; packets that would wait longer than the
+#                sim backlog are dropped
+#
+# For each run: connect time, how long until every write was made and every device
+# reported its new brightness, packets the mesh dropped and the gap pacing ended at.
+#
+#   python3 benchmarks/bench_pacing.py [--devices 100] [--rate 10] [--airtime 0.004]
+import argparse
+import asyncio
+import json
+import sys
+import time
+from pathlib import Path
+
+SRC=Path(__file__).resolve().parent.parent/'src'
+sys.path.insert(0,str(SRC))
+
+from acync import acync
+
+def make_config(count, rate, pacing, simoptions):
+    bulbs={id: {'mac': f'A4:C1:38:00:{id>>8:02X}:{id&0xff:02X}', 'name': f'Bulb {id}'} for id in range(1,count+1)}
+    return {'meshconfig': {1: {'mac': 'AABBCCDD0001', 'name': 'mesh_1', 'access_key': 123456, 'usebtlib': 'sim', 'command_rate': rate,
+                               'pacing': pacing, 'bulbs': bulbs, 'sim': simoptions}}}
+
+async def run(count, rate, pacing, simoptions, rounds):
+    meshes=acync()
+    meshes.populate_from_configdict(make_config(count,rate,pacing,simoptions))
+    mesh=meshes.networks['mesh_1']
+    simmesh=meshes.simmeshes['mesh_1']
+    start=time.perf_counter()
+    await meshes.connect()
+    connected=time.perf_counter()-start
+    await mesh.status_sweep(5)
+
+    result={'connect_s': round(connected,3), 'rounds': []}
+    devices=list(mesh.devices.values())
+    for burst in range(rounds):
+        brightness=10+burst*20
+        dropped=simmesh.dropped
+        start=time.perf_counter()
+        written=await asyncio.gather(*(device.set_brightness(brightness) for device in devices))
+        writes_done=time.perf_counter()-start
+        # echoes of dropped packets never come - resend those until every device got there
+        deadline=start+60
+        while time.perf_counter()<deadline:
+            behind=[device for device in devices if simmesh.devices[device.id].brightness!=brightness]
+            if not behind: break
+            await asyncio.sleep(1)
+            behind=[device for device in devices if simmesh.devices[device.id].brightness!=brightness]
+            await asyncio.gather(*(device.set_brightness(brightness) for device in behind))
+        result['rounds'].append({'writes_s': round(writes_done,3), 'all_applied_s': round(time.perf_counter()-start,3),
+                                 'written': sum(written), 'dropped': simmesh.dropped-dropped,
+                                 'gap_ms': round(1000*mesh.links[0].flow.gap,1) if mesh.links else None})
+
+    await meshes.disconnect()
+    simmesh.close()
+    return result
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--devices",type=int,default=100,help="devices in the mesh (up to 250)")
+    parser.add_argument("--rate",type=float,default=10,help="command_rate (packets per second)")
+    parser.add_argument("--airtime",type=float,default=0.004,help="seconds the healthy mesh needs per control packet")
+    parser.add_argument("--rounds",type=int,default=3,help="bursts per run")
+    args = parser.parse_args()
+
+    results={'devices': args.devices, 'command_rate': args.rate}
+    for name,airtime in (('healthy',args.airtime),('congested',10*args.airtime)):
+        simoptions={'latency': 0.01, 'airtime': airtime}
+        for pacing in ('fixed','adaptive'):
+            results[f'{name}_{pacing}']=asyncio.run(run(min(args.devices,250),args.rate,pacing,simoptions,args.rounds))
+    print(json.dumps({'benchmark': 'pacing', 'results': results},indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# Control packet write pipeline on a simulated mesh (no mqtt).  Every write takes
+# --write-time seconds to return, like a GATT write through BlueZ, and the mesh itself
+# is fast.  For each write_window: a burst of colour temperature commands, one per
+# device (a whole floor), and a burst of power+brightness+temperature to each device.
+# Reported are how long until every write returned and the packets per second.
+#
+#   python3 benchmarks/bench_pipeline.py [--devices 100] [--write-time 0.03] [--windows 1 4 8]
+import argparse
+import asyncio
+import json
+import sys
+import time
+from pathlib import Path
+
+SRC=Path(__file__).resolve().parent.parent/'src'
+sys.path.insert(0,str(SRC))
+
+from acync import acync
+
+def make_config(count, window, simoptions):
+    bulbs={id: {'mac': f'A4:C1:38:00:{id>>8:02X}:{id&0xff:02X}', 'name': f'Bulb {id}', 'supports_temperature': True} for id in range(1,count+1)}
+    return {'meshconfig': {1: {'mac': 'AABBCCDD0001', 'name': 'mesh_1', 'access_key': 123456, 'usebtlib': 'sim',
+                               'write_window': window, 'bulbs': bulbs, 'sim': simoptions}}}
+
+async def run(count, window, simoptions, rounds):
+    meshes=acync()
+    meshes.populate_from_configdict(make_config(count,window,simoptions))
+    mesh=meshes.networks['mesh_1']
+    simmesh=meshes.simmeshes['mesh_1']
+    await meshes.connect()
+    await mesh.status_sweep(5)
+    devices=list(mesh.devices.values())
+
+    result={'floor': [], 'multi': []}
+    for burst in range(rounds):
+        commands=simmesh.commands
+        start=time.perf_counter()
+        written=await asyncio.gather(*(device.set_temperature(20+30*(burst%2)) for device in devices))
+        elapsed=time.perf_counter()-start
+        result['floor'].append({'writes_s': round(elapsed,3), 'written': sum(written),
+                                'packets_per_s': round((simmesh.commands-commands)/elapsed,1)})
+    for burst in range(rounds):
+        commands=simmesh.commands
+        start=time.perf_counter()
+        written=await asyncio.gather(*(device.apply_state(power=True,brightness=30+20*(burst%2),color_temp=10+40*(burst%2)) for device in devices))
+        elapsed=time.perf_counter()-start
+        result['multi'].append({'writes_s': round(elapsed,3), 'written': sum(written),
+                                'packets_per_s': round((simmesh.commands-commands)/elapsed,1)})
+    result['gap_ms']=round(1000*mesh.links[0].flow.gap,1)
+
+    await meshes.disconnect()
+    simmesh.close()
+    return result
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--devices",type=int,default=100,help="devices in the mesh (up to 250)")
+    parser.add_argument("--write-time",type=float,default=0.03,help="seconds a control packet write takes to return")
+    parser.add_argument("--windows",type=int,nargs='+',default=[1,4,8],help="write_window values to compare")
+    parser.add_argument("--rounds",type=int,default=3,help="bursts of each kind")
+    args = parser.parse_args()
+
+    simoptions={'latency': 0.01, 'airtime': 0.002, 'write_time': args.write_time}
+    results={'devices': args.devices, 'write_time': args.write_time}
+    for window in args.windows:
+        results[f'window_{window}']=asyncio.run(run(min(args.devices,250),window,simoptions,args.rounds))
+    print(json.dumps({'benchmark': 'pipeline', 'results': results},indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# Import time and config load time of the bridge, each measured in fresh interpreters.
+#
+#   import_acync        import acync (bluetooth libraries, pycryptodome and requests load lazily)
+#   import_eager        import acync plus everything it used to import at load time
+#   load_yaml           parse the YAML config and populate_from_configdict
+#   load_snapshot       load the compiled JSON snapshot and populate_from_configdict
+#   process_yaml/_snapshot   whole bridge process start: imports + config + populate
+#
+# Run it on the target board, e.g. a Pi Zero:
+#   python3 benchmarks/bench_startup.py [--devices 50 500] [--runs 5]
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+SRC=Path(__file__).resolve().parent.parent/'src'
+
+EAGER_MODULES=('bleak','bluepy.btle','Crypto.Cipher.AES','requests')
+
+def timed(code, runs):
+    # median seconds of the statement in code, each run in a new interpreter
+    env=dict(os.environ)
+    env['PYTHONPATH']=os.pathsep.join([str(SRC)]+([env['PYTHONPATH']] if 'PYTHONPATH' in env else []))
+    script="import time\nstart=time.perf_counter()\n"+code+"\nprint(time.perf_counter()-start)\n"
+    samples=[]
+    for run in range(runs):
+        result=subprocess.run([sys.executable,'-c',script],env=env,capture_output=True,text=True)
+        if result.returncode!=0:
+            raise SystemExit(result.stderr)
+        samples.append(float(result.stdout.strip().splitlines()[-1]))
+    return round(statistics.median(samples)*1000,1)
+
+def available(module):
+    result=subprocess.run([sys.executable,'-c',f'import {module}'],capture_output=True)
+    return result.returncode==0
+
+def write_config(path, count):
+    import yaml
+    meshconfig={}
+    meshid=0
+    while count>0:
+        meshid+=1
+        size=min(count,250)
+        count-=size
+        bulbs={id: {'mac': f'A4C1{meshid:02X}0000{id:02X}', 'name': f'Bulb {meshid}-{id}', 'type': 137 if id%2 else 65} for id in range(1,size+1)}
+        meshconfig[1000+meshid]={'mac': f'AABBCCDD00{meshid:02X}', 'access_key': 100000+meshid, 'name': f'mesh {meshid}', 'bulbs': bulbs,
+                                 'groups': {1: {'name': 'Odd', 'members': list(range(1,size+1,2))}, 2: {'name': 'All', 'broadcast': True}}}
+    with path.open("wt") as fp:
+        yaml.dump({'mqtt_url': 'mqtt://127.0.0.1:1883/', 'meshconfig': meshconfig},fp)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--devices",type=int,nargs='+',default=[50,500],help="device counts of the generated configs")
+    parser.add_argument("--runs",type=int,default=5,help="fresh interpreters per measurement (median is reported)")
+    args = parser.parse_args()
+
+    eager=[module for module in EAGER_MODULES if available(module)]
+    results={'python': sys.version.split()[0],
+             'import_acync_ms': timed('import acync',args.runs),
+             'import_eager_ms': timed('import acync\n'+'\n'.join(f'import {module}' for module in eager),args.runs),
+             'eager_modules': eager,
+             'configs': []}
+
+    populate="from acync import acync\nacync().populate_from_configdict(configdict)"
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for count in args.devices:
+            configpath=Path(tmpdir)/f'config_{count}.yaml'
+            snapshotpath=Path(tmpdir)/f'config_{count}_snapshot.json'
+            write_config(configpath,count)
+            # compile the snapshot once
+            timed(f'from acync.config import load_configdict\nload_configdict({str(configpath)!r},{str(snapshotpath)!r})',1)
+
+            load_yaml=f'from acync.config import load_configdict\nconfigdict=load_configdict({str(configpath)!r})\n'
+            load_snapshot=f'from acync.config import load_configdict\nconfigdict=load_configdict({str(configpath)!r},{str(snapshotpath)!r})\n'
+            # the bridge process also imports amqtt before loading the config
+            bridge='import amqtt.client\n' if available('amqtt') else ''
+            results['configs'].append({'devices': count,
+                'load_yaml_ms': timed('import acync\n'+bridge+'start=time.perf_counter()\n'+load_yaml+populate,args.runs),
+                'load_snapshot_ms': timed('import acync\n'+bridge+'start=time.perf_counter()\n'+load_snapshot+populate,args.runs),
+                'process_yaml_ms': timed(bridge+load_yaml+populate,args.runs),
+                'process_snapshot_ms': timed(bridge+load_snapshot+populate,args.runs)})
+
+    print(json.dumps({'benchmark': 'startup', 'results': results},indent=2))
+
+if __name__ == "__main__":
+    main()
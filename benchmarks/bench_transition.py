@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# Fades through the bridge on simulated meshes, sent the way home assistant sends a
+# light group transition: one {"state": "ON", "brightness": b, "transition": t} per light.
+#
+#   lockstep     all lights start from the same brightness - frames are merged into
+#                broadcast packets
+#   divergent    every light starts from a different brightness - one packet per light
+#                per frame, frame rate limited by the mesh command_rate
+#
+# For each run: mesh packets written, brightness steps each light received, the largest
+# gap between steps and when the last light reached the target.
+#
+#   python3 benchmarks/bench_transition.py [--devices 32] [--duration 3] [--rate 20]
+import argparse
+import asyncio
+import json
+import statistics
+import time
+
+from amqtt.broker import Broker
+from amqtt.client import MQTTClient
+from amqtt.mqtt.constants import QOS_0
+
+from bench_e2e import load_cync2mqtt, make_config, observer
+
+async def fade(bridge, publisher, devicenames, mesh, simmesh, start, target, duration):
+    # set the start brightness, then fade everything to target
+    for devicename,brightness in zip(devicenames,start):
+        await publisher.publish(f'acyncmqtt/set/{devicename}',json.dumps({'state': 'ON', 'brightness': brightness}).encode(),qos=QOS_0)
+    devices=[bridge.meshnetworks.devices[devicename] for devicename in devicenames]
+    deadline=time.perf_counter()+5+2*len(devicenames)/mesh.scheduler.rate
+    while [device.brightness for device in devices]!=list(start) and time.perf_counter()<deadline:
+        await asyncio.sleep(0.05)
+    await asyncio.sleep(0.5)
+
+    steps={devicename: [] for devicename in devicenames}
+    ids={device.id: devicename for devicename,device in bridge.meshnetworks.devices.items() if device.network is mesh}
+    groups={newgroup.id: [member.id for member in newgroup.members] for newgroup in mesh.groups.values()}
+    def on_command(target, command, data):
+        if command!=0xd2: return
+        now=time.perf_counter()
+        for id in (list(ids) if target==0xffff else groups.get(target,[target])):
+            if id in ids and ids[id] in steps:
+                steps[ids[id]].append((now,data[0]))
+    simmesh.on_command=on_command
+    packets=mesh.scheduler.stats()['sent']
+
+    sent=time.perf_counter()
+    for devicename in devicenames:
+        await publisher.publish(f'acyncmqtt/set/{devicename}',json.dumps({'state': 'ON', 'brightness': target, 'transition': duration}).encode(),qos=QOS_0)
+    while mesh.transitions.stats()['running']==0 and time.perf_counter()<sent+5:
+        await asyncio.sleep(0.01)
+    while (mesh.transitions.stats()['running'] or mesh.scheduler.stats()['pending']) and time.perf_counter()<sent+duration+30:
+        await asyncio.sleep(0.01)
+    simmesh.on_command=None
+
+    finished=[timeline[-1][0]-sent for timeline in steps.values() if timeline and timeline[-1][1]==target]
+    gaps=[max(b[0]-a[0] for a,b in zip(timeline,timeline[1:])) for timeline in steps.values() if len(timeline)>1]
+    return {'packets': mesh.scheduler.stats()['sent']-packets,
+            'steps_per_light': round(statistics.mean(len(timeline) for timeline in steps.values()),1),
+            'max_step_gap_s': round(max(gaps),3) if gaps else None,
+            'reached_target': len(finished),
+            'last_done_s': round(max(finished),3) if finished else None}
+
+async def run_bench(cync2mqtt, count, duration, rate, port):
+    configdict=make_config(count,port,rate,{'latency': 0.01})
+    broker=Broker({'listeners': {'default': {'type': 'tcp', 'bind': f'127.0.0.1:{port}'}}, 'sys_interval': 0,
+                   'auth': {'allow-anonymous': True, 'plugins': ['auth_anonymous']}, 'topic-check': {'enabled': False}})
+    await broker.start()
+    watcher=observer('acyncmqtt')
+    await watcher.start(configdict['mqtt_url'])
+    publisher=MQTTClient()
+    await publisher.connect(configdict['mqtt_url'])
+
+    bridge=cync2mqtt.cync2mqtt(configdict)
+    bridgetask=asyncio.create_task(bridge.run_mqtt())
+    while len(watcher.online)<count:
+        await asyncio.sleep(0.01)
+        if bridgetask.done():
+            raise SystemExit("bridge exited during startup")
+
+    mesh=next(iter(bridge.meshnetworks.networks.values()))
+    simmesh=next(iter(bridge.meshnetworks.simmeshes.values()))
+    devicenames=[devicename for devicename,device in bridge.meshnetworks.devices.items() if device.network is mesh]
+    results={'devices': len(devicenames), 'duration': duration, 'command_rate': rate}
+    results['lockstep']=await fade(bridge,publisher,devicenames,mesh,simmesh,[20]*len(devicenames),90,duration)
+    results['divergent']=await fade(bridge,publisher,devicenames,mesh,simmesh,[10+(i*60)//len(devicenames) for i in range(len(devicenames))],90,duration)
+
+    bridgetask.cancel()
+    await asyncio.gather(bridgetask,return_exceptions=True)
+    for simmesh in bridge.meshnetworks.simmeshes.values():
+        simmesh.close()
+    await publisher.disconnect()
+    await watcher.stop()
+    await broker.shutdown()
+    return results
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--devices",type=int,default=32,help="lights fading at once (one mesh, up to 250)")
+    parser.add_argument("--duration",type=float,default=3,help="transition seconds")
+    parser.add_argument("--rate",type=float,default=20,help="mesh command_rate (packets per second)")
+    parser.add_argument("--port",type=int,default=18885,help="port of the in-process MQTT broker")
+    args = parser.parse_args()
+
+    cync2mqtt=load_cync2mqtt()
+    results=asyncio.run(run_bench(cync2mqtt,min(args.devices,250),args.duration,args.rate,args.port))
+    print(json.dumps({'benchmark': 'transition', 'results': results},indent=2))
+
+if __name__ == "__main__":
+    main()
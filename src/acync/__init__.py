@@ -22,97 +22,72 @@
 # Copyright 2016 Matthew Garrett <mjg59@srcf.ucam.org>
 
 
-import random
-import requests
-import getpass
 import json
 from pathlib import Path
-from acync.mesh import network,device
+from acync.mesh import network,device,group
+from acync.nodescores import node_scores
+from acync.config import normalize_mac
 import logging
-import re
+import asyncio
+import itertools
 
 logger=logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
 
-class xlinkException(Exception):
-    pass
-
-def randomLoginResource():
-    return ''.join([chr(ord('a')+random.randint(0,26)) for i in range(0,16)])
+def __getattr__(name):
+    # cloud helpers used to live here - import them (and requests) only when asked for
+    if name in ('xlinkException','randomLoginResource'):
+        from acync import cloud
+        return getattr(cloud,name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 class acync:
-    API_TIMEOUT = 5
-    # https://github.com/unixpickle/cbyge/blob/main/login.go
-    def _authenticate_2fa():
-        """Authenticate with the API and get a token."""
-        username=input("Enter Username (or emailed code):")
-        if re.match('^\d+$',username):
-            code=username
-            username=input("Enter Username:")
-        else:
-            API_AUTH = "https://api.gelighting.com/v2/two_factor/email/verifycode"
-            auth_data = {'corp_id': "1007d2ad150c4000", 'email': username,"local_lang": "en-us"}
-            r = requests.post(API_AUTH, json=auth_data, timeout=acync.API_TIMEOUT)
-            code=input("Enter emailed code:")
-            
-        password=getpass.getpass()
-        API_AUTH = "https://api.gelighting.com/v2/user_auth/two_factor"
-        auth_data = {'corp_id': "1007d2ad150c4000", 'email': username,
-                    'password': password, "two_factor": code, "resource": randomLoginResource()}
-        r = requests.post(API_AUTH, json=auth_data, timeout=acync.API_TIMEOUT)
-
-        try:
-            return (r.json()['access_token'], r.json()['user_id'])
-        except KeyError:
-            raise(xlinkException('API authentication failed'))
-
-
-    def _get_devices(auth_token, user):
-        """Get a list of devices for a particular user."""
-        API_DEVICES = "https://api.gelighting.com/v2/user/{user}/subscribe/devices"
-        headers = {'Access-Token': auth_token}
-        r = requests.get(API_DEVICES.format(user=user), headers=headers,
-                        timeout=acync.API_TIMEOUT)
-        return r.json()
-
-    def _get_properties(auth_token, product_id, device_id):
-        """Get properties for a single device."""
-        API_DEVICE_INFO = "https://api.gelighting.com/v2/product/{product_id}/device/{device_id}/property"
-        headers = {'Access-Token': auth_token}
-        r = requests.get(API_DEVICE_INFO.format(product_id=product_id, device_id=device_id), headers=headers, timeout=acync.API_TIMEOUT)
-        return r.json()
-
-    def get_app_meshinfo():
-        (auth,userid)=acync._authenticate_2fa()
-        mesh_networks=acync._get_devices(auth, userid)
-        for mesh in mesh_networks:
-            mesh['properties']=acync._get_properties(auth, mesh['product_id'],mesh['id'])
-        return mesh_networks
-
-    def app_meshinfo_to_configdict(meshinfo):
+    def get_app_meshinfo(**kwargs):
+        from acync import cloud
+        return cloud.get_app_meshinfo(**kwargs)
+
+    # config keys that come from the cloud - anything else in an existing config is a local setting
+    cloud_mesh_keys=('access_key','name','mac')
+    cloud_bulb_keys=('name','mac')
+    # capability flags can also be set by hand - the cloud only adds them, never clears them
+    cloud_capability_keys=('is_plug','supports_temperature','supports_rgb')
+
+    def app_meshinfo_to_configdict(meshinfo, existing=None):
+        # With an existing configdict the cloud data is merged into it: cloud keys are
+        # replaced, local settings (mqtt_url, usebtlib, priority, groups, capability
+        # overrides, ...) are kept, bulbs no longer in the cloud are dropped and meshes
+        # that are not in the cloud are left alone.
+        existingmeshes=existing['meshconfig'] if existing is not None and 'meshconfig' in existing else {}
         meshconfig={}
 
         for mesh in meshinfo:
             if 'name' not in mesh or len(mesh['name'])<1: continue
-            newmesh={kv: mesh[kv] for kv in ('access_key','name','mac') if kv in mesh}
+            newmesh={kv: value for kv,value in existingmeshes.get(mesh['id'],{}).items() if kv not in acync.cloud_mesh_keys and kv!='bulbs'}
+            newmesh.update({kv: mesh[kv] for kv in acync.cloud_mesh_keys if kv in mesh})
             meshconfig[mesh['id']]=newmesh
             
             if 'properties' not in mesh or 'bulbsArray' not in mesh['properties']: continue
 
+            existingbulbs=existingmeshes.get(mesh['id'],{}).get('bulbs',{})
             newmesh['bulbs']={}
             for bulb in mesh['properties']['bulbsArray']:
                 if any(checkattr not in bulb for checkattr in ('deviceID','displayName','mac','deviceType')): continue
                 id = int(str(bulb['deviceID'])[-3:])
                 bulbdevice=device(None,bulb['displayName'], id, bulb['mac'],bulb['deviceType'])
-                newbulb={}
-                for attrset in ('name','is_plug','supports_temperature','supports_rgb','mac'):
+                newbulb={kv: value for kv,value in existingbulbs.get(id,{}).items() if kv not in acync.cloud_bulb_keys}
+                for attrset in acync.cloud_bulb_keys+acync.cloud_capability_keys:
                     value=getattr(bulbdevice,attrset)
                     if value:
                         newbulb[attrset]=value
                 newmesh['bulbs'][id]=newbulb
 
-        configdict={}
-        configdict['mqtt_url']='mqtt://127.0.0.1:1883/'
+        for meshid,mesh in existingmeshes.items():
+            if meshid not in meshconfig:
+                meshconfig[meshid]=mesh
+
+        configdict=dict(existing) if existing is not None else {}
+        if 'mqtt_url' not in configdict:
+            configdict['mqtt_url']='mqtt://127.0.0.1:1883/'
         configdict['meshconfig']=meshconfig
 
         return configdict
@@ -120,30 +95,31 @@ class acync:
     def __init__(self,**kwargs):
         self.networks={}
         self.devices={}
+        self.groups={}
+        self.membergroups={}
+        self.simmeshes={}
         self.meshmap={}
         self.xlinkdata=None
         self.callback = kwargs.get('callback',None)
+        # connect history per mesh node, persisted if a file is given
+        self.nodescores = node_scores(kwargs.get('node_score_file',None))
 
-    # define our callback handler
+    # define our callback handler - the network has already updated the device
     async def _callback_routine(self,devicestatus):
-        device=self.devices[f"{devicestatus.name}/{devicestatus.id}"]
-        device.online=True
-        for attr in ('brightness','red','green','blue','color_temp'):
-            setattr(device,attr,getattr(devicestatus,attr))
         if self.callback is not None:
             await self.callback(self,devicestatus)
 
     def populate_from_configdict(self, configdict):
+        # configdict may be a compiled snapshot (acync.config) with node MACs, capability
+        # flags, topic names and group members already worked out
         for meshid, mesh in configdict['meshconfig'].items():
             if 'name' not in mesh:
                 mesh['name'] = f'mesh_{meshid}'
-            meshmacs = {}
             if 'bulbs' in mesh: #Ignore empty meshes returned by CYNC API
-                for bulb in mesh['bulbs'].values():
-                    # support MAC in config with either colons or not
-                    mac = bulb['mac'].replace(':', '')
-                    mac = ':'.join(mac[i:i+2] for i in range(0, 12, 2))
-                    meshmacs[mac] = bulb['priority'] if 'priority' in bulb else 0
+                if 'meshmacs' in mesh:
+                    meshmacs = dict(mesh['meshmacs'])
+                else:
+                    meshmacs = {normalize_mac(bulb['mac']): bulb['priority'] if 'priority' in bulb else 0 for bulb in mesh['bulbs'].values()}
 
                 # print(f"Add network: {mesh['name']}")
                 self.meshmap[mesh['mac']] = mesh['name']
@@ -151,7 +127,24 @@ class acync:
                 usebtlib = None
                 if 'usebtlib' in mesh:
                     usebtlib = mesh['usebtlib']
-                mesh_network = network(meshmacs, mesh['mac'], str(mesh['access_key']), usebtlib=usebtlib)
+                # packets per second the command scheduler may send to this mesh
+                rate = mesh['command_rate'] if 'command_rate' in mesh else None
+                # how many mesh nodes to try pairing with in parallel
+                race = mesh['connect_race'] if 'connect_race' in mesh else None
+                # paired connections to different nodes kept at once
+                links = mesh['links'] if 'links' in mesh else None
+                # 'adaptive' or 'fixed' packet pacing
+                pacing = mesh['pacing'] if 'pacing' in mesh else None
+                # control packet writes in flight at once per link
+                window = mesh['write_window'] if 'write_window' in mesh else None
+                btoptions = {}
+                if 'bluepy_notify' in mesh:
+                    btoptions['notify_mode'] = mesh['bluepy_notify']
+                if 'measure_latency' in mesh:
+                    btoptions['measure_latency'] = mesh['measure_latency']
+                mesh_network = network(meshmacs, mesh['mac'], str(mesh['access_key']), usebtlib=usebtlib, rate=rate, race=race, scores=self.nodescores, btoptions=btoptions, links=links, pacing=pacing, window=window)
+                if usebtlib == 'sim':
+                    self._populate_sim(mesh, meshmacs)
 
                 async def cb(devicestatus):
                     return await self._callback_routine(devicestatus)
@@ -167,7 +160,42 @@ class acync:
                     for attrset in ('is_plug', 'supports_temperature', 'supports_rgb'):
                         if attrset in bulb:
                             setattr(newdevice, attrset, bulb[attrset])
-                    self.devices[f"{mesh['mac']}/{bulbid}"] = newdevice
+                    devicename = bulb['devicename'] if 'devicename' in bulb else f"{mesh['mac']}/{bulbid}"
+                    self.devices[devicename] = newdevice
+                    mesh_network.add_device(devicename, newdevice)
+
+                for groupid, groupcfg in (mesh['groups'] if 'groups' in mesh else {}).items():
+                    groupname = groupcfg['devicename'] if 'devicename' in groupcfg else f"{mesh['mac']}/group{groupid}"
+                    if groupcfg.get('broadcast', False):
+                        memberids = list(mesh['bulbs'].keys())
+                        address = group.BROADCAST
+                    else:
+                        memberids = groupcfg['members'] if 'members' in groupcfg else []
+                        address = groupcfg['address'] if 'address' in groupcfg else None
+                    members = [self.devices[f"{mesh['mac']}/{bulbid}"] for bulbid in memberids if f"{mesh['mac']}/{bulbid}" in self.devices]
+                    newgroup = group(mesh_network, groupcfg['name'] if 'name' in groupcfg else f"group_{groupid}", groupid, members, address)
+                    for attrset in ('is_plug', 'supports_temperature', 'supports_rgb'):
+                        if attrset in groupcfg:
+                            setattr(newgroup, attrset, groupcfg[attrset])
+                    self.groups[groupname] = newgroup
+                    mesh_network.add_group(groupname, newgroup)
+                    for bulbid in memberids:
+                        self.membergroups.setdefault(f"{mesh['mac']}/{bulbid}", []).append(groupname)
+
+    def _populate_sim(self, mesh, meshmacs):
+        # virtual devices for usebtlib: sim, with options from the mesh 'sim' section
+        from acync import sim
+        groups = {}
+        for groupid, groupcfg in (mesh['groups'] if 'groups' in mesh else {}).items():
+            if groupcfg.get('broadcast', False): continue
+            address = groupcfg['address'] if 'address' in groupcfg else 0x8000 | groupid
+            groups[address] = groupcfg['members'] if 'members' in groupcfg else []
+        simoptions = mesh['sim'] if 'sim' in mesh else {}
+        self.simmeshes[mesh['name']] = sim.sim_mesh(mesh['mac'], str(mesh['access_key']), list(meshmacs), list(mesh['bulbs'].keys()), groups=groups, **simoptions)
+
+    def all_devices(self):
+        # devices followed by groups, keyed by their mqtt topic name
+        return itertools.chain(self.devices.items(),self.groups.items())
 
     def populate_from_jsonfile(self,jsonfile):
         jsonfile=Path(jsonfile)
@@ -188,7 +216,7 @@ class acync:
             usebtlib=None
             if 'usebtlib' in mesh: 
                 usebtlib=mesh['usebtlib']
-            mesh_network=network(meshmacs,mesh['mac'],str(mesh['access_key']),usebtlib=usebtlib)
+            mesh_network=network(meshmacs,mesh['mac'],str(mesh['access_key']),usebtlib=usebtlib,scores=self.nodescores)
             async def cb(devicestatus):
                 return await self._callback_routine(devicestatus)
             mesh_network.callback=cb
@@ -198,21 +226,50 @@ class acync:
             for bulb in mesh['properties']['bulbsArray']:
                 id = int(bulb['deviceID'][-3:])
                 self.devices[f"{mesh['mac']}/{id}"]=device(mesh_network,bulb['displayName'], id, bulb['mac'],bulb['deviceType'])
+                mesh_network.add_device(f"{mesh['mac']}/{id}",self.devices[f"{mesh['mac']}/{id}"])
 
     async def disconnect(self):
-        for device in self.devices.values():
-            device.online=False
+        for mesh in self.networks.values():
+            mesh.mark_offline()
 
         for mesh in self.networks.values():
+            await mesh.transitions.close()
+            await mesh.scheduler.close()
             await mesh.disconnect()
 
-    async def connect(self):
+    async def connect(self, timeout=None, callback=None):
+        # Connect all meshes concurrently.  Each one is reported through callback(meshname, ok)
+        # as soon as it finishes, and a mesh that is not up within timeout seconds is given
+        # up on without holding the others back.
+        async def connect_mesh(meshname, mesh):
+            try:
+                ok=await asyncio.wait_for(mesh.connect(), timeout)
+            except asyncio.TimeoutError:
+                logger.info(f"Mesh {meshname} not connected within {timeout} seconds")
+                await mesh.disconnect()
+                ok=False
+            except Exception as e:
+                logger.info(f"Mesh {meshname} connect failed: {e}")
+                await mesh.disconnect()
+                ok=False
+            if not ok:
+                # given up on here - whoever supervises the mesh retries
+                mesh.link_lost.set()
+            return (meshname, ok)
+
         connected=list()
+        tasks=[asyncio.create_task(connect_mesh(meshname,mesh)) for meshname,mesh in self.networks.items()]
         try:
-            for meshname,mesh in self.networks.items():
-                if await mesh.connect():
+            for nextdone in asyncio.as_completed(tasks):
+                (meshname, ok)=await nextdone
+                if ok:
                     connected.append(meshname)
+                if callback is not None:
+                    await callback(meshname, ok)
         except:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
             await self.disconnect()
             raise Exception("Unable to connect to mesh network(s)")
 
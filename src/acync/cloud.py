@@ -0,0 +1,120 @@
+# Cync cloud API helpers - only needed to download the mesh configuration, so this
+# module (and requests) is imported on first use rather than with acync.
+
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Contains code derived from python-tikteck,
+# Copyright 2016 Matthew Garrett <mjg59@srcf.ucam.org>
+
+import random
+import requests
+import getpass
+import re
+import json
+import time
+import concurrent.futures
+from pathlib import Path
+
+from acync.jsonfile import write_json
+
+API_TIMEOUT = 5
+API_URL = "https://api.gelighting.com/v2"
+# mesh property downloads in flight at once
+API_WORKERS = 8
+
+class xlinkException(Exception):
+    pass
+
+def randomLoginResource():
+    return ''.join([chr(ord('a')+random.randint(0,26)) for i in range(0,16)])
+
+def api_session(workers=API_WORKERS):
+    # one keep-alive connection pool shared by all requests (and worker threads)
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max(1,workers))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+# https://github.com/unixpickle/cbyge/blob/main/login.go
+def _authenticate_2fa(session=None, api_url=API_URL):
+    """Authenticate with the API and get a token."""
+    session = session if session is not None else requests
+    username=input("Enter Username (or emailed code):")
+    if re.match(r'^\d+$',username):
+        code=username
+        username=input("Enter Username:")
+    else:
+        API_AUTH = f"{api_url}/two_factor/email/verifycode"
+        auth_data = {'corp_id': "1007d2ad150c4000", 'email': username,"local_lang": "en-us"}
+        r = session.post(API_AUTH, json=auth_data, timeout=API_TIMEOUT)
+        code=input("Enter emailed code:")
+        
+    password=getpass.getpass()
+    API_AUTH = f"{api_url}/user_auth/two_factor"
+    auth_data = {'corp_id': "1007d2ad150c4000", 'email': username,
+                'password': password, "two_factor": code, "resource": randomLoginResource()}
+    r = session.post(API_AUTH, json=auth_data, timeout=API_TIMEOUT)
+
+    try:
+        return (r.json()['access_token'], r.json()['user_id'])
+    except KeyError:
+        raise(xlinkException('API authentication failed'))
+
+
+def _get_devices(auth_token, user, session=None, api_url=API_URL):
+    """Get a list of devices for a particular user."""
+    session = session if session is not None else requests
+    API_DEVICES = api_url+"/user/{user}/subscribe/devices"
+    headers = {'Access-Token': auth_token}
+    r = session.get(API_DEVICES.format(user=user), headers=headers,
+                    timeout=API_TIMEOUT)
+    return r.json()
+
+def _get_properties(auth_token, product_id, device_id, session=None, api_url=API_URL):
+    """Get properties for a single device."""
+    session = session if session is not None else requests
+    API_DEVICE_INFO = api_url+"/product/{product_id}/device/{device_id}/property"
+    headers = {'Access-Token': auth_token}
+    r = session.get(API_DEVICE_INFO.format(product_id=product_id, device_id=device_id), headers=headers, timeout=API_TIMEOUT)
+    return r.json()
+
+def fetch_meshinfo(auth_token, user, session=None, api_url=API_URL, workers=API_WORKERS):
+    """Get all meshes of a user with their properties, fetched concurrently."""
+    session = session if session is not None else api_session(workers)
+    mesh_networks=_get_devices(auth_token, user, session, api_url)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1,workers)) as executor:
+        properties=executor.map(lambda mesh: _get_properties(auth_token, mesh['product_id'], mesh['id'], session, api_url), mesh_networks)
+        for mesh,meshproperties in zip(mesh_networks,properties):
+            mesh['properties']=meshproperties
+    return mesh_networks
+
+def get_app_meshinfo(api_url=API_URL, workers=API_WORKERS):
+    session=api_session(workers)
+    (auth,userid)=_authenticate_2fa(session, api_url)
+    return fetch_meshinfo(auth, userid, session, api_url, workers)
+
+def load_meshinfo_cache(path, ttl):
+    # raw mesh info saved by save_meshinfo_cache, or None if missing or older than ttl seconds
+    try:
+        with Path(path).open("rt") as fp:
+            cache=json.load(fp)
+        if time.time()-cache['fetched']>ttl: return None
+        return cache['meshinfo']
+    except (FileNotFoundError, KeyError, TypeError, ValueError):
+        return None
+
+def save_meshinfo_cache(path, meshinfo):
+    write_json(path, {'fetched': time.time(), 'meshinfo': meshinfo})
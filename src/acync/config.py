@@ -0,0 +1,94 @@
+import copy
+import json
+import logging
+from pathlib import Path
+
+from acync.jsonfile import write_json
+from acync.mesh import device,group
+
+logger=logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+# A config snapshot is the YAML configdict with everything populate_from_configdict
+# would otherwise work out on every start already resolved - normalized node MACs and
+# priorities, device capability flags and topic names, group members and addresses -
+# stored as JSON together with the size and mtime of the YAML it was compiled from.
+
+SNAPSHOT_VERSION=1
+
+def normalize_mac(mac):
+    # support MAC in config with either colons or not
+    mac = mac.replace(':', '')
+    return ':'.join(mac[i:i+2] for i in range(0, 12, 2))
+
+def compile_configdict(configdict):
+    compiled=copy.deepcopy(configdict)
+    for meshid, mesh in compiled['meshconfig'].items():
+        if 'name' not in mesh:
+            mesh['name'] = f'mesh_{meshid}'
+        if 'bulbs' not in mesh: continue
+
+        mesh['meshmacs'] = {normalize_mac(bulb['mac']): bulb['priority'] if 'priority' in bulb else 0 for bulb in mesh['bulbs'].values()}
+        for bulbid, bulb in mesh['bulbs'].items():
+            bulb['devicename'] = f"{mesh['mac']}/{bulbid}"
+            capabilities = device(None, None, bulbid, bulb['mac'], bulb['type'] if 'type' in bulb else None)
+            for attrset in ('is_plug', 'supports_temperature', 'supports_rgb'):
+                if attrset not in bulb:
+                    bulb[attrset] = getattr(capabilities, attrset)
+
+        for groupid, groupcfg in (mesh['groups'] if 'groups' in mesh else {}).items():
+            groupcfg['devicename'] = f"{mesh['mac']}/group{groupid}"
+            if groupcfg.get('broadcast', False):
+                groupcfg['members'] = list(mesh['bulbs'].keys())
+                groupcfg['address'] = group.BROADCAST
+            else:
+                groupcfg['members'] = [bulbid for bulbid in (groupcfg['members'] if 'members' in groupcfg else []) if bulbid in mesh['bulbs']]
+                groupcfg['address'] = groupcfg['address'] if 'address' in groupcfg else 0x8000 | groupid
+    compiled['snapshot'] = {'version': SNAPSHOT_VERSION}
+    return compiled
+
+def _source_stamp(path):
+    stat = path.stat()
+    return {'path': str(path.resolve()), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+def _restore_keys(configdict):
+    # JSON object keys are strings - mesh, device and group ids are ints in the YAML
+    configdict['meshconfig'] = {int(key) if key.isdigit() else key: mesh for key, mesh in configdict['meshconfig'].items()}
+    for mesh in configdict['meshconfig'].values():
+        for section in ('bulbs', 'groups'):
+            if section in mesh:
+                mesh[section] = {int(key): value for key, value in mesh[section].items()}
+        for groupcfg in (mesh['groups'] if 'groups' in mesh else {}).values():
+            if 'members' in groupcfg:
+                groupcfg['members'] = [int(member) for member in groupcfg['members']]
+    return configdict
+
+def load_configdict(yamlpath, snapshotpath=None):
+    # Load the YAML config, or its snapshot if that was compiled from the same file.
+    # A missing or stale snapshot is (re)written after parsing the YAML.
+    yamlpath = Path(yamlpath)
+    if snapshotpath is not None:
+        snapshotpath = Path(snapshotpath)
+        try:
+            with snapshotpath.open("rt") as fp:
+                snapshot = json.load(fp)
+            if snapshot.get('snapshot', {}).get('version') == SNAPSHOT_VERSION and snapshot['snapshot'].get('source') == _source_stamp(yamlpath):
+                return _restore_keys(snapshot)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.info(f"Ignoring config snapshot {snapshotpath}: {e}")
+
+    import yaml
+    with yamlpath.open("rt") as fp:
+        configdict = yaml.safe_load(fp)
+    if snapshotpath is None or not isinstance(configdict, dict) or 'meshconfig' not in configdict:
+        return configdict
+
+    compiled = compile_configdict(configdict)
+    compiled['snapshot']['source'] = _source_stamp(yamlpath)
+    try:
+        write_json(snapshotpath, compiled)
+    except Exception as e:
+        logger.info(f"Unable to write config snapshot {snapshotpath}: {e}")
+    return compiled
@@ -0,0 +1,15 @@
+import json
+import os
+from pathlib import Path
+
+def write_json(path, data, indent=None):
+    # Replace path with data as JSON through a temp file next to it, so a reader never
+    # sees it half written.  Readable by the owner only - some of these files (cloud
+    # cache, config snapshot) hold the mesh access keys.
+    path=Path(path)
+    tmppath=path.with_name(path.name+'.tmp')
+    fd=os.open(tmppath, os.O_WRONLY|os.O_CREAT|os.O_TRUNC, 0o600)
+    os.fchmod(fd, 0o600)
+    with os.fdopen(fd, "wt") as fp:
+        json.dump(data, fp, indent=indent)
+    os.replace(tmppath, path)
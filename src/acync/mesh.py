@@ -27,22 +27,43 @@
 # Contains code derived from python-tikteck,
 # Copyright 2016 Matthew Garrett <mjg59@srcf.ucam.org>
 
-from bleak import BleakClient
-import bluepy.btle
-from Crypto.Cipher import AES
-from Crypto.Random import get_random_bytes
 import random
 import asyncio
-from collections import namedtuple
+import time
+from collections import namedtuple,deque
 import logging
 import queue
 import functools
 import concurrent.futures
+import threading
+import select
+import os
+from array import array
+from acync.scheduler import command_scheduler,completed
+from acync.transition import transition_engine
+from acync.metrics import default_registry
 
 logger=logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
 
+connect_seconds=default_registry.histogram('acync_connect_seconds','Time spent connecting and pairing with a mesh',('mesh',))
+connects_total=default_registry.counter('acync_connects_total','Mesh connect attempts by result',('mesh','result'))
+node_failures_total=default_registry.counter('acync_node_failures_total','Failed connect or pairing attempts per mesh node',('mesh','node'))
+packets_sent_total=default_registry.counter('acync_packets_sent_total','Control packets written to a mesh',('mesh',))
+packet_write_seconds=default_registry.histogram('acync_packet_write_seconds','Control packet write latency',('mesh',))
+send_retries_total=default_registry.counter('acync_send_retries_total','Failed packet writes that caused a reconnect and retry',('mesh',))
+status_requests_total=default_registry.counter('acync_status_requests_total','Status dump requests by result',('mesh','result'))
+status_refreshes_total=default_registry.counter('acync_status_refreshes_total','Periodic status refreshes by kind (full sweep, targeted, none needed)',('mesh','kind'))
+status_queries_total=default_registry.counter('acync_status_queries_total','Status requests addressed to single stale devices',('mesh',))
+notifications_total=default_registry.counter('acync_notifications_total','Notifications received from a mesh',('mesh',))
+notification_duplicates_total=default_registry.counter('acync_notification_duplicates_total','Notifications discarded as another copy of one already received',('mesh',))
+links_lost_total=default_registry.counter('acync_links_lost_total','Mesh connections dropped or given up on',('mesh',))
+echo_seconds=default_registry.histogram('acync_echo_seconds','Control packet write to status notification from the commanded device',('mesh',))
+echo_losses_total=default_registry.counter('acync_echo_losses_total','Control packets whose status notification did not arrive in time',('mesh',))
+link_failovers_total=default_registry.counter('acync_link_failovers_total','Writes moved to another link of the mesh after a link failed',('mesh',))
+
 def encrypt(key, data):
+    from Crypto.Cipher import AES
     k = AES.new(bytes(reversed(key)), AES.MODE_ECB)
     data = reversed(list(k.encrypt(bytes(reversed(data)))))
     rev = []
@@ -99,46 +120,284 @@ def decrypt_packet(sk, address, packet):
 
     return packet
 
-class bluepyDelegate(bluepy.btle.DefaultDelegate):
-    def __init__(self, notifyqueue):
-        bluepy.btle.DefaultDelegate.__init__(self)
-        self.notifyqueue=notifyqueue
+def _xor(a, b):
+    # xor two equal length byte strings in a single big-int operation
+    return (int.from_bytes(a,'little') ^ int.from_bytes(b,'little')).to_bytes(len(a),'little')
+
+class telink_crypto(object):
+    # Per-session equivalent of encrypt/encrypt_packet/decrypt_packet above.
+    # The AES object and the byte-reversed key are built once when the session key
+    # is derived, and packets are bytearrays modified in place.
+    def __init__(self, sk, macdata):
+        from Crypto.Cipher import AES
+        self._cipher=AES.new(bytes(sk)[::-1], AES.MODE_ECB)
+        self._address=bytes(macdata)
+        # constant parts of the nonces
+        self._auth_prefix=self._address[0:4]+b'\x01'
+        self._iv_prefix=b'\x00'+self._address[0:4]+b'\x01'
+        self._notify_prefix=b'\x00'+self._address[0:3]
+
+    def encrypt(self, data):
+        return self._cipher.encrypt(bytes(data)[::-1])[::-1]
+
+    def encrypt_packet(self, packet):
+        header=bytes(packet[0:3])
+        authenticator=self.encrypt(self._auth_prefix+header+b'\x0f'+bytes(7))
+        mac=self.encrypt(_xor(authenticator[0:15],packet[5:20])+authenticator[15:16])
+        packet[3:5]=mac[0:2]
+        packet[5:20]=_xor(packet[5:20],self.encrypt(self._iv_prefix+header+bytes(7))[0:15])
+        return packet
+
+    def decrypt_packet(self, packet):
+        size=len(packet)-7
+        if size<=0: return packet
+        result=self.encrypt(self._notify_prefix+bytes(packet[0:5])+bytes(7))
+        packet[7:]=_xor(packet[7:],result[0:size])
+        return packet
+
+def load_backend(uselib):
+    # Bluetooth libraries are imported when a network first selects them, so a bridge
+    # using one of them never pays for loading the other
+    if uselib=="bleak":
+        import bleak
+        return bleak
+    elif uselib=="bluepy":
+        import bluepy.btle
+        return bluepy.btle
+    elif uselib=="sim":
+        from acync import sim
+        return sim
+    raise ValueError(f"bluetooth library: {uselib} not supported")
+
+bluepyDelegate=None
+
+def bluepy_delegate(deliver):
+    # the DefaultDelegate subclass is defined on first use, after bluepy was imported
+    global bluepyDelegate
+    if bluepyDelegate is None:
+        btle=load_backend("bluepy")
+
+        class bluepyDelegate(btle.DefaultDelegate):
+            def __init__(self, deliver):
+                btle.DefaultDelegate.__init__(self)
+                self.deliver=deliver
+
+            def handleNotification(self, cHandle, data):
+                # called on the bluepy I/O thread
+                self.deliver(cHandle,data)
+
+    return bluepyDelegate(deliver)
+
+class bluepy_worker(object):
+    # One long-lived I/O thread per bluepy connection.  bluepy is blocking and not thread
+    # safe, so every call on the Peripheral is queued here and run in submission order.
+    # Callers do not need a lock and several writes can be queued at once.
+    #
+    # Once pump() is called the thread also blocks on the bluepy helper's output whenever
+    # it has nothing else to do, so notifications are read the moment they arrive.  A wake
+    # pipe interrupts that wait when a command is submitted.
+    def __init__(self, name, lost=None):
+        self._commands=queue.SimpleQueue()
+        self._peripheral=None
+        # called on the I/O thread when the connection fails while pumping notifications
+        self._lost=lost
+        self._wake_r,self._wake_w=os.pipe()
+        self._thread=threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def _next_command(self):
+        if self._peripheral is None:
+            return self._commands.get()
+        while True:
+            try:
+                return self._commands.get_nowait()
+            except queue.Empty:
+                pass
+            helper=self._peripheral._helper
+            if helper is None:
+                self._peripheral=None
+                return self._commands.get()
+            (ready,_,_)=select.select([helper.stdout,self._wake_r],[],[])
+            if self._wake_r in ready:
+                os.read(self._wake_r,512)
+            if helper.stdout in ready:
+                try:
+                    self._peripheral.waitForNotifications(0.001)
+                except Exception as e:
+                    logger.info(f"bluepy notification pump stopped: {e}")
+                    self._peripheral=None
+                    if self._lost is not None:
+                        self._lost()
 
-    def handleNotification(self, cHandle, data):
-        self.notifyqueue.put((cHandle,data))
+    def _run(self):
+        while True:
+            command=self._next_command()
+            if command is None:
+                os.close(self._wake_r)
+                os.close(self._wake_w)
+                return
+            (future,fn,args,kwargs)=command
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(*args,**kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+
+    def _put(self, command):
+        self._commands.put(command)
+        if self._peripheral is not None:
+            os.write(self._wake_w,b'\0')
+
+    def submit(self, fn, *args, **kwargs):
+        future=concurrent.futures.Future()
+        self._put((future,fn,args,kwargs))
+        return asyncio.wrap_future(future)
+
+    def pump(self, peripheral):
+        # start reading notifications from peripheral continuously between commands
+        return self.submit(setattr, self, '_peripheral', peripheral)
+
+    def shutdown(self):
+        # the thread exits once the commands already queued have run
+        self._put(None)
+
+class latency_stats(object):
+    # Optional timing of the bluepy notification and write paths (measure_latency)
+    #  notify: notification read on the I/O thread -> callback started on the event loop
+    #  write: write submitted -> write completed
+    #  echo: control write completed -> next notification read
+    def __init__(self, name):
+        self.name=name
+        self.samples={'notify': [], 'write': [], 'echo': []}
+        self.lastwrite=None
+
+    def add(self, kind, seconds):
+        samples=self.samples[kind]
+        samples.append(seconds)
+        if len(samples)>10000:
+            del samples[0:5000]
+
+    def summary(self):
+        result={}
+        for kind,samples in self.samples.items():
+            if not samples: continue
+            ordered=sorted(samples)
+            result[kind]={'count': len(ordered),
+                          'p50_ms': round(1000*ordered[len(ordered)//2],2),
+                          'p95_ms': round(1000*ordered[int(len(ordered)*0.95)],2),
+                          'max_ms': round(1000*ordered[-1],2)}
+        return result
+
+class flow_control(object):
+    # Inter-packet gap of one link, adapted to how fast the mesh echoes commands with a
+    # 0xdc status notification from the commanded device.  The echo time beyond the
+    # lowest seen tells how many packets are queued in the mesh: the gap shrinks
+    # while that is under one and is backed off when it is over three or an echo does
+    # not arrive at all.  The gap changes
+    # at most once per echo time, so echoes of packets sent before the last change do
+    # not push it further.  With adaptive False the gap stays at the configured
+    # command_rate and echoes are only measured.
+    MIN_GAP=0.02
+    MAX_GAP=1.0
+
+    def __init__(self, rate, adaptive=True):
+        self.adaptive=adaptive
+        self.gap=1.0/rate
+        self.min_gap=min(flow_control.MIN_GAP,self.gap)
+        self.srtt=None
+        self.base=None
+        self.echoes=0
+        self.losses=0
+        self._changed=0
+
+    def _hold(self, now):
+        # True while the last change has not had an echo time to take effect
+        if now-self._changed<(self.srtt if self.srtt is not None else 0): return True
+        self._changed=now
+        return False
+
+    def echo(self, rtt, now):
+        self.echoes+=1
+        if self.srtt is None:
+            (self.srtt,self.base)=(rtt,rtt)
+        else:
+            self.srtt=0.875*self.srtt+0.125*rtt
+            # the floor creeps up slowly so a mesh that got slower for good is not
+            # treated as congested forever
+            self.base=min(rtt,self.base+0.001*(rtt-self.base))
+        if not self.adaptive: return
+        # packets waiting in the mesh: the echo time beyond the floor, in gaps
+        queued=(rtt-self.base)/self.gap
+        if queued<1:
+            if not self._hold(now): self.gap=max(self.min_gap,self.gap*0.8)
+        elif queued>3:
+            if not self._hold(now): self.gap=min(flow_control.MAX_GAP,self.gap*min(2.0,1+0.1*queued))
+
+    def loss(self, now):
+        self.losses+=1
+        if self.adaptive and not self._hold(now):
+            self.gap=min(flow_control.MAX_GAP,self.gap*2)
+
+    def timeout(self):
+        # how long to wait for an echo or a handshake reply - the old fixed 0.3s until measured
+        if self.srtt is None: return 0.3
+        return min(1.0,max(0.1,4*self.srtt))
+
+    def rate(self):
+        return 1.0/self.gap
 
 class btle_gatt(object):
-    def __init__(self, mac,uselib="bleak"):
+    def __init__(self, mac,uselib="bleak",notify_mode=None,measure_latency=False,disconnected_callback=None):
         self.mac=mac
         self.is_connected=None
+        # called with this btle_gatt when the link drops without disconnect() being called
+        self.disconnected_callback=disconnected_callback
         self.notifytasks=None
         self.notifyqueue= None
+        self.worker=None
         self._notifycallbacks={}
         self.loop=asyncio.get_running_loop()
-        self.bluepy_lock = asyncio.Lock()
+        # bluepy only: 'pump' reads notifications as they arrive, 'poll' is the old 0.25s poll loop
+        self.notify_mode=notify_mode if notify_mode is not None else 'pump'
+        self.latency=latency_stats(mac) if measure_latency else None
 
+        self.backend=load_backend(uselib)
+        self.bluepy=uselib=="bluepy"
         if uselib=="bleak":
-            self.client=BleakClient(mac)
+            self.client=self.backend.BleakClient(mac,disconnected_callback=self._client_disconnected)
         elif uselib=="bluepy":
-            self.client=bluepy.btle.Peripheral()
+            self.client=self.backend.Peripheral()
         else:
-            raise ValueError(f"bluetooth library: {uselib} not supported")
+            self.client=self.backend.sim_client(mac,disconnected_callback=self._client_disconnected)
+
+    def _client_disconnected(self, client=None):
+        # link lost - a disconnect() of our own has already cleared is_connected
+        if not self.is_connected: return
+        self.is_connected=False
+        if self.disconnected_callback is not None:
+            self.disconnected_callback(self)
+
+    def _deliver(self, handle, data):
+        # bluepy I/O thread -> event loop, no executor hop
+        received=time.perf_counter()
+        if self.latency is not None and self.latency.lastwrite is not None:
+            self.latency.add('echo',received-self.latency.lastwrite)
+            self.latency.lastwrite=None
+        self.loop.call_soon_threadsafe(self.notifyqueue.put_nowait,(handle,data,received))
 
     async def notify_worker(self):
-        pool=concurrent.futures.ThreadPoolExecutor(1)
         while True:
-            (handle,data)=await self.loop.run_in_executor(pool,self.notifyqueue.get)
+            (handle,data,received)=await self.notifyqueue.get()
+            if self.latency is not None:
+                self.latency.add('notify',time.perf_counter()-received)
             if handle in self._notifycallbacks:
                 await self._notifycallbacks[handle](handle,data)
 
-            await self.loop.run_in_executor(pool,self.notifyqueue.task_done)
-
     async def notify_waiter(self):
-        pool=concurrent.futures.ThreadPoolExecutor(1)
         while True:
             await asyncio.sleep(0.25)
-            async with self.bluepy_lock:
-                await self.loop.run_in_executor(pool,self.client.waitForNotifications,0.25)
+            await self.worker.submit(self.client.waitForNotifications,0.25)
  
     async def connect(self,timeout=20):
         self.macdata=None
@@ -147,14 +406,19 @@ class btle_gatt(object):
 
         if self.is_connected: return
 
-        if isinstance(self.client,bluepy.btle.Peripheral):
-            async with self.bluepy_lock:
-                result = await self.loop.run_in_executor(concurrent.futures.ThreadPoolExecutor(1), functools.partial(self.client.connect,self.mac, addrType=bluepy.btle.ADDR_TYPE_PUBLIC))
-                self.notifyqueue=queue.Queue()
-                self.notifytasks=[]
-                self.notifytasks.append(asyncio.create_task(self.notify_worker()))
-                self.client.setDelegate( bluepyDelegate(self.notifyqueue))
-                self.is_connected=True
+        if self.bluepy:
+            self.worker=bluepy_worker(f"bluepy-{self.mac}",lost=lambda: self.loop.call_soon_threadsafe(self._client_disconnected))
+            try:
+                result = await self.worker.submit(self.client.connect,self.mac, addrType=self.backend.ADDR_TYPE_PUBLIC)
+            except:
+                self.worker.shutdown()
+                self.worker=None
+                raise
+            self.notifyqueue=asyncio.Queue()
+            self.notifytasks=[]
+            self.notifytasks.append(asyncio.create_task(self.notify_worker()))
+            self.client.setDelegate( bluepy_delegate(self._deliver))
+            self.is_connected=True
             return result
         else:
             status=await self.client.connect(timeout=timeout)
@@ -165,26 +429,31 @@ class btle_gatt(object):
         if uuid in self._uuidchars:
             return self._uuidchars[uuid]
         else:
-            async with self.bluepy_lock:
-                char=(await self.loop.run_in_executor(concurrent.futures.ThreadPoolExecutor(1), functools.partial(self.client.getCharacteristics,uuid=uuid)))[0]
-                self._uuidchars[uuid]=char
+            char=(await self.worker.submit(self.client.getCharacteristics,uuid=uuid))[0]
+            self._uuidchars[uuid]=char
             return char
 
     async def write_gatt_char(self,uuid,data,withResponse=False):
-        if isinstance(self.client,bluepy.btle.Peripheral):
+        if self.bluepy:
             char=await self.bluepy_get_char_from_uuid(uuid)
-            async with self.bluepy_lock:
-                result=await self.loop.run_in_executor(concurrent.futures.ThreadPoolExecutor(1), functools.partial(char.write,data,withResponse=withResponse))
+            if self.latency is None:
+                return await self.worker.submit(char.write,data,withResponse=withResponse)
+            start=time.perf_counter()
+            def timed_write():
+                # stamped on the I/O thread so an echo read right after the write is not missed
+                result=char.write(data,withResponse=withResponse)
+                self.latency.lastwrite=time.perf_counter()
+                return result
+            result=await self.worker.submit(timed_write)
+            self.latency.add('write',time.perf_counter()-start)
             return result
         else:
             return await self.client.write_gatt_char(uuid,data,withResponse)
 
     async def read_gatt_char(self,uuid):
-        if isinstance(self.client,bluepy.btle.Peripheral):
+        if self.bluepy:
             char=await self.bluepy_get_char_from_uuid(uuid)
-            async with self.bluepy_lock:
-                result=await self.loop.run_in_executor(concurrent.futures.ThreadPoolExecutor(1), char.read)
-            return result
+            return await self.worker.submit(char.read)
         else:
             return await self.client.read_gatt_char(uuid)
 
@@ -192,24 +461,98 @@ class btle_gatt(object):
         if self.notifytasks is not None:
             for notifytask in self.notifytasks:
                 notifytask.cancel()
+        self.is_connected=False
+        if self.latency is not None:
+            logger.info(f"{self.mac} {self.notify_mode} latency: {self.latency.summary()}")
 
-        if isinstance(self.client,bluepy.btle.Peripheral):
-            async with self.bluepy_lock:
-                result=await self.loop.run_in_executor(concurrent.futures.ThreadPoolExecutor(1), self.client.disconnect)
+        if self.bluepy:
+            if self.worker is None: return
+            try:
+                result=await self.worker.submit(self.client.disconnect)
+            finally:
+                self.worker.shutdown()
+                self.worker=None
             return result
         else:
             return await self.client.disconnect()
 
     async def start_notify(self,uuid, callback_handler):
-        if isinstance(self.client,bluepy.btle.Peripheral):
+        if self.bluepy:
             char=await self.bluepy_get_char_from_uuid(uuid)
-            async with self.bluepy_lock:
-                handle=await self.loop.run_in_executor(concurrent.futures.ThreadPoolExecutor(1),char.getHandle)
+            handle=await self.worker.submit(char.getHandle)
             self._notifycallbacks[handle]=callback_handler
-            self.notifytasks.append(asyncio.create_task(self.notify_waiter()))
+            if self.notify_mode=='poll':
+                self.notifytasks.append(asyncio.create_task(self.notify_waiter()))
+            else:
+                await self.worker.pump(self.client)
         else:
             return await self.client.start_notify(uuid,callback_handler)
 
+class write_pipeline(object):
+    # Control packets queued for one link.  Writes (without response) are started in
+    # queue order without waiting for the one before to complete, at most window of
+    # them at once.  put() returns a future for that packet alone: True once written, or
+    # the write's exception.  A failed write fails every packet queued behind it.
+    def __init__(self, client, window=1, latency=None):
+        self.client = client
+        self.window = max(1, window)
+        self.latency = latency
+        self.queued = deque()
+        self.inflight = 0
+        self._tasks = set()
+
+    def put(self, packet):
+        future = asyncio.get_running_loop().create_future()
+        self.queued.append((packet, future))
+        self._pump()
+        return future
+
+    def _pump(self):
+        while self.queued and self.inflight < self.window:
+            (packet, future) = self.queued.popleft()
+            # the caller gave up waiting
+            if future.done(): continue
+            self.inflight += 1
+            task = asyncio.ensure_future(self._write(packet, future))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _write(self, packet, future):
+        start = time.perf_counter()
+        try:
+            await self.client.write_gatt_char(atelink_mesh.control_char, packet)
+        except Exception as e:
+            self.fail(e)
+            if not future.done(): future.set_exception(e)
+        else:
+            if self.latency is not None: self.latency.observe(time.perf_counter()-start)
+            if not future.done(): future.set_result(True)
+        finally:
+            self.inflight -= 1
+            self._pump()
+
+    def fail(self, error):
+        # fail the packets not started yet - the link is gone or a write to it failed
+        while self.queued:
+            (packet, future) = self.queued.popleft()
+            if not future.done(): future.set_exception(error)
+
+class mesh_link(object):
+    # a paired connection to one mesh node and its session crypto
+    def __init__(self, mac, client, macdata, sk, flow=None, window=1, latency=None):
+        self.mac = mac
+        self.client = client
+        self.macdata = macdata
+        self.sk = sk
+        self.crypto = telink_crypto(sk, macdata)
+        # batches in progress and packets written through this link - sends go to the least busy link
+        self.busy = 0
+        self.sent = 0
+        self.flow = flow
+        self.pipeline = write_pipeline(client, window, latency)
+        # set by every notification that arrives through this link
+        self.notified = asyncio.Event()
+
 class atelink_mesh:
     #http://wiki.telink-semi.cn/wiki/protocols/Telink-Mesh/
 
@@ -217,7 +560,7 @@ class atelink_mesh:
     control_char="00010203-0405-0607-0809-0a0b0c0d1912"
     pairing_char="00010203-0405-0607-0809-0a0b0c0d1914"
 
-    def __init__(self, vendor, meshmacs, name, password, usebtlib=None):
+    def __init__(self, vendor, meshmacs, name, password, usebtlib=None, rate=None, race=None, scores=None, btoptions=None, links=None, pacing=None, window=None):
         self.vendor = vendor
         self.meshmacs = {x: 0 for x in meshmacs} if type(meshmacs) is list else meshmacs
         self.name = name
@@ -225,12 +568,50 @@ class atelink_mesh:
         self.packet_count = random.randrange(0xffff)
         self.macdata = None
         self.sk = None
+        self.crypto = None
         self.client = None
         self.currentmac = None
         if usebtlib is None:
             self.uselib = 'bleak'
         else:
             self.uselib = usebtlib
+        self.scheduler = command_scheduler(self, rate)
+        self._connecting = None
+        # how many candidate nodes are paired with in parallel on connect
+        if race is not None:
+            self.race = max(1, race)
+        else:
+            self.race = 1 if self.uselib == 'bluepy' else 2
+        self.scores = scores
+        # Paired connections kept to different nodes at once.  links[0] is the primary
+        # (self.client, self.sk, ... refer to it); the others are added in the background
+        # and take over without a reconnect when a link fails.
+        self.wanted_links = max(1, links) if links else 1
+        self.links = []
+        self._filling = None
+        self._closing = set()
+        # 'adaptive' (default): the gap between packets follows the echo time of each link,
+        # starting at command_rate.  'fixed': command_rate packets per second per link.
+        self.adaptive = pacing != 'fixed'
+        # control packet writes in flight at once per link
+        self.window = max(1, window) if window else 4
+        # control writes waiting for their echo: device id -> (link, time written)
+        self._echoes = {}
+        # smoothed time from writing the pairing request until the reply can be read
+        self._handshake = 0.1
+        # extra btle_gatt arguments (notify_mode, measure_latency)
+        self.btoptions = btoptions if btoptions is not None else {}
+        self._connect_seconds = connect_seconds.labels(name)
+        self._packets_sent = packets_sent_total.labels(name)
+        self._packet_write_seconds = packet_write_seconds.labels(name)
+        self._send_retries = send_retries_total.labels(name)
+        self._links_lost = links_lost_total.labels(name)
+        self._failovers = link_failovers_total.labels(name)
+        self._echo_seconds = echo_seconds.labels(name)
+        self._echo_losses = echo_losses_total.labels(name)
+        # set when the connection dropped or could not be (re)established - whoever
+        # supervises the mesh reconnects it and clears this
+        self.link_lost = asyncio.Event()
 
     async def __aenter__(self):
         await self.connect()
@@ -240,102 +621,336 @@ class atelink_mesh:
         await self.disconnect()
 
     async def disconnect(self):
-        if self.client is not None:
+        # a connect attempt still running (e.g. past its caller's deadline) is given up too
+        if self._connecting is not None and not self._connecting.done():
+            self._connecting.cancel()
+            await asyncio.gather(self._connecting, return_exceptions=True)
+        if self._filling is not None:
+            self._filling.cancel()
+            await asyncio.gather(self._filling, return_exceptions=True)
+            self._filling = None
+        clients = [link.client for link in self.links]
+        if self.client is not None and self.client not in clients:
+            clients.insert(0, self.client)
+        self.links = []
+        for client in clients:
             try:
-                await self.client.disconnect()
+                await client.disconnect()
             except Exception as e:
                 logger.info(f"disconnect returned false: {e}")
-            self.client = None
+        self.client = None
 
-    async def callback_handler(self, sender, data):
-        print("{0}: {1}".format(sender, decrypt_packet(self.sk, self.macdata, list(data))))
+    def _use(self, link):
+        # make link the primary connection (None: no connection left)
+        self.client = link.client if link is not None else None
+        self.currentmac = link.mac if link is not None else None
+        self.macdata = link.macdata if link is not None else None
+        self.sk = link.sk if link is not None else None
+        self.crypto = link.crypto if link is not None else None
+
+    def _drop_link(self, link):
+        # Take a failed link out of use and close it in the background.  If it was the
+        # primary the next live link takes over.  Returns True if a link is left.
+        if link not in self.links:
+            return len(self.links) > 0
+        self.links.remove(link)
+        link.pipeline.fail(ConnectionError(f"link to {link.mac} dropped"))
+        for id in [id for id,(echolink,written) in self._echoes.items() if echolink is link]:
+            del self._echoes[id]
+        if link.mac in self.meshmacs:
+            self.meshmacs[link.mac] += 1
+        if link.client is self.client:
+            self._use(self.links[0] if self.links else None)
+            if self.links:
+                logger.info(f"Mesh {self.name} failed over from {link.mac} to {self.currentmac}")
+        if self.links:
+            self._failovers.inc()
+            self._fill_links()
+        task = asyncio.ensure_future(self._close_link(link))
+        self._closing.add(task)
+        task.add_done_callback(self._closing.discard)
+        return len(self.links) > 0
+
+    async def _close_link(self, link):
+        try:
+            await link.client.disconnect()
+        except Exception as e:
+            logger.debug(f"disconnect of {link.mac} returned false: {e}")
+
+    def _link_lost(self, client):
+        # disconnected_callback of a connected node (racers and closed links are ignored)
+        link = next((link for link in self.links if link.client is client), None)
+        if link is None: return
+        logger.info(f"Lost connection to mesh mac: {client.mac}")
+        self._links_lost.inc()
+        if not self._drop_link(link):
+            self.link_lost.set()
+
+    def lanes(self):
+        # sends that can be in progress at once - a write window per live link
+        return max(1, len(self.links))*self.window
+
+    def throughput(self):
+        # packets per second the live links take at their current gaps
+        if not self.links: return self.scheduler.rate
+        return sum(link.flow.rate() for link in self.links)
+
+    def _echo_ids(self, target):
+        # ids whose status notification answers a write to target (none for a bare mesh)
+        return ()
+
+    def _expect_echo(self, target, link, written):
+        for id in self._echo_ids(target):
+            self._echoes.setdefault(id, (link, written))
+
+    def _echoed(self, id, received):
+        # a status notification from id - the echo of the oldest write to it not yet answered
+        (link, written) = self._echoes.pop(id)
+        self._echo_seconds.observe(received-written)
+        link.flow.echo(received-written, received)
+
+    def _expire_echoes(self, now):
+        for id,(link,written) in list(self._echoes.items()):
+            if now-written > link.flow.timeout():
+                del self._echoes[id]
+                self._echo_losses.inc()
+                link.flow.loss(now)
+                logger.debug(f"no echo from device {id} on {self.name} - gap of {link.mac} now {link.flow.gap:.3f}s")
+
+    async def _link_notify(self, link, sender, data):
+        link.notified.set()
+        await self.callback_handler(sender, data, link=link)
+
+    def _pick_link(self):
+        # least busy link, round robin between idle ones
+        return min(self.links, key=lambda link: (link.busy, link.sent))
+
+    async def callback_handler(self, sender, data, link=None):
+        crypto = link.crypto if link is not None else self.crypto
+        print("{0}: {1}".format(sender, list(crypto.decrypt_packet(bytearray(data)))))
 
     async def connect(self):
+        # concurrent callers (status sweeps, commands, startup) share one connection attempt -
+        # shielded so a caller that times out or is cancelled does not cancel it for the rest
+        if self._connecting is None or self._connecting.done():
+            self._connecting = asyncio.ensure_future(self._connect())
+        connecting = self._connecting
+        try:
+            return await asyncio.shield(connecting)
+        except asyncio.CancelledError:
+            # the attempt itself was given up by disconnect(), not this caller
+            if connecting.cancelled(): return False
+            raise
+
+    def _node_rank(self, mac):
+        # configured priority / failures this session first, then the persisted node score
+        return (self.meshmacs[mac], self.scores.score(mac) if self.scores is not None else 0)
+
+    async def _pair(self, mac):
+        # Connect to one mesh node and derive a session key.  Returns a mesh_link, or None
+        # if the node could not be paired.
+        client = btle_gatt(mac, uselib=self.uselib, disconnected_callback=self._link_lost, **self.btoptions)
+        start = time.monotonic()
+        try:
+            try:
+                logger.info(f"Attempting to connect to mesh mac: {mac}")
+                await client.connect(timeout=30)  # Increased timeout
+            except Exception as e:
+                self.meshmacs[mac] += 1
+                if self.scores is not None: self.scores.record_failure(mac)
+                node_failures_total.labels(self.name, mac).inc()
+                logger.info(f"Unable to connect to mesh mac: {mac}, Error: {e}")
+                await asyncio.sleep(0.1)
+                return None
+            if not client.is_connected:
+                logger.info(f"Unable to connect to mesh mac: {mac}")
+                return None
+
+            macarray = mac.split(':')
+            macdata = [int(macarray[5], 16), int(macarray[4], 16), int(macarray[3], 16), int(macarray[2], 16), int(macarray[1], 16), int(macarray[0], 16)]
+
+            data = [0] * 16
+            random_data = os.urandom(8)
+            for i in range(8):
+                data[i] = random_data[i]
+            enc_data = key_encrypt(self.name, self.password, data)
+            packet = [0x0c]
+            packet += data[0:8]
+            packet += enc_data[0:8]
+
+            try:
+                await client.write_gatt_char(atelink_mesh.pairing_char, bytes(packet), True)
+                data2 = await self._pair_reply(client)
+            except Exception as e:
+                logger.info(f"Unable to connect to mesh mac: {mac}, Error during pairing: {e}")
+                if self.scores is not None: self.scores.record_failure(mac)
+                node_failures_total.labels(self.name, mac).inc()
+                await client.disconnect()
+                return None
+        except asyncio.CancelledError:
+            # lost the race to another node
+            try:
+                await client.disconnect()
+            except Exception:
+                pass
+            raise
+
+        if self.scores is not None: self.scores.record_success(mac, time.monotonic()-start)
+        return mesh_link(mac, client, macdata, generate_sk(self.name, self.password, data[0:8], data2[1:9]), flow_control(self.scheduler.rate, self.adaptive), self.window, self._packet_write_seconds)
+
+    async def _pair_reply(self, client):
+        # Read the pairing reply (0x0d, or 0x0e if refused) as soon as the node has it,
+        # rather than after a fixed 0.3s: first after the time recent handshakes took,
+        # then every 20ms.  Until then the characteristic still reads as the 0x0c request.
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        await asyncio.sleep(self._handshake)
+        while True:
+            data2 = await client.read_gatt_char(atelink_mesh.pairing_char)
+            if data2[0] != 0x0c or loop.time()-start > 2.0:
+                break
+            await asyncio.sleep(0.02)
+        self._handshake = 0.7*self._handshake + 0.3*max(0.01, loop.time()-start-0.02)
+        return data2
+
+    async def _race(self, candidates):
+        # Pair with up to self.race candidates at once, starting the next candidate whenever
+        # one fails.  The first node to finish pairing wins and the others are cancelled.
+        candidates = list(candidates)
+        pending = set()
+        winner = None
+        try:
+            while winner is None and (candidates or pending):
+                while candidates and len(pending) < self.race:
+                    pending.add(asyncio.create_task(self._pair(candidates.pop(0))))
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    link = task.result()
+                    if link is None:
+                        continue
+                    if winner is None:
+                        winner = link
+                    else:
+                        await link.client.disconnect()
+        finally:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        return winner
+
+    async def _connect(self):
         self.macdata = None
         self.sk = None
+        self.crypto = None
 
-        for retry in range(0, 3):
-            if self.sk is not None:
-                break
-            for mac in sorted(self.meshmacs, key=lambda x: self.meshmacs[x]):
-                if self.meshmacs[mac] < 0:
+        start = time.monotonic()
+        try:
+            for retry in range(0, 3):
+                link = await self._race(mac for mac in sorted(self.meshmacs, key=self._node_rank) if self.meshmacs[mac] >= 0)
+                if link is None:
                     continue
-                self.client = btle_gatt(mac, uselib=self.uselib)
 
-                try:
-                    logger.info(f"Attempting to connect to mesh mac: {mac}")
-                    await self.client.connect(timeout=30)  # Increased timeout
-                except Exception as e:
-                    self.meshmacs[mac] += 1
-                    logger.info(f"Unable to connect to mesh mac: {mac}, Error: {e}")
-                    await asyncio.sleep(0.1)
-                    continue
-                if not self.client.is_connected:
-                    logger.info(f"Unable to connect to mesh mac: {mac}")
+                self._use(link)
+                self.links = [link]
+                if not await self._start_link(link):
+                    self.links = []
+                    self.sk = None
+                    self.crypto = None
                     continue
+                logger.info(f"Connected to mesh mac: {link.mac}")
+                self._fill_links()
+                break
+        except asyncio.CancelledError:
+            # given up by disconnect(), which closes anything paired so far
+            self.sk = None
+            raise
+        finally:
+            if self.scores is not None: self.scores.save()
+            self._connect_seconds.observe(time.monotonic() - start)
+            connects_total.labels(self.name, 'ok' if self.sk is not None else 'failed').inc()
+            if self.sk is None:
+                self.link_lost.set()
 
-                self.currentmac = mac
-                macarray = mac.split(':')
-                self.macdata = [int(macarray[5], 16), int(macarray[4], 16), int(macarray[3], 16), int(macarray[2], 16), int(macarray[1], 16), int(macarray[0], 16)]
+        return self.sk is not None
 
-                data = [0] * 16
-                random_data = get_random_bytes(8)
-                for i in range(8):
-                    data[i] = random_data[i]
-                enc_data = key_encrypt(self.name, self.password, data)
-                packet = [0x0c]
-                packet += data[0:8]
-                packet += enc_data[0:8]
+    async def _start_link(self, link):
+        # Enable notifications from a freshly paired node - they are decrypted with its
+        # session key.  The status dump requested here is waited for (at most the link's
+        # echo timeout) instead of sleeping a fixed time.
+        try:
+            await link.client.start_notify(atelink_mesh.notification_char, functools.partial(self._link_notify, link))
+            link.notified.clear()
+            await link.client.write_gatt_char(atelink_mesh.notification_char, bytes([0x1]), True)
+            await self._wait_notified(link)
+            data3 = await link.client.read_gatt_char(atelink_mesh.notification_char)
+        except Exception as e:
+            logger.info(f"Unable to connect to mesh mac for notify: {link.mac} - {e}")
+            if self.scores is not None: self.scores.record_failure(link.mac)
+            node_failures_total.labels(self.name, link.mac).inc()
+            await link.client.disconnect()
+            return False
+        return True
 
-                try:
-                    await self.client.write_gatt_char(atelink_mesh.pairing_char, bytes(packet), True)
-                    await asyncio.sleep(0.3)
-                    data2 = await self.client.read_gatt_char(atelink_mesh.pairing_char)
-                except Exception as e:
-                    logger.info(f"Unable to connect to mesh mac: {mac}, Error during pairing: {e}")
-                    await self.client.disconnect()
-                    self.sk = None
+    async def _wait_notified(self, link):
+        try:
+            await asyncio.wait_for(link.notified.wait(), link.flow.timeout())
+        except asyncio.TimeoutError:
+            pass
+
+    def _fill_links(self):
+        if len(self.links) < self.wanted_links and (self._filling is None or self._filling.done()):
+            self._filling = asyncio.ensure_future(self._add_links())
+
+    async def _add_links(self):
+        # Pair with further nodes until wanted_links are up, backing off while none can be had
+        delay = 5
+        while self.online and len(self.links) < self.wanted_links:
+            inuse = {link.mac for link in self.links}
+            link = await self._race(mac for mac in sorted(self.meshmacs, key=self._node_rank) if self.meshmacs[mac] >= 0 and mac not in inuse)
+            if link is not None:
+                if await self._start_link(link):
+                    if not self.online:
+                        await link.client.disconnect()
+                        break
+                    self.links.append(link)
+                    logger.info(f"Added link {len(self.links)}/{self.wanted_links} to mesh mac: {link.mac}")
+                    delay = 5
                     continue
-                else:
-                    self.sk = generate_sk(self.name, self.password, data[0:8], data2[1:9])
-
-                    try:
-                        await self.client.start_notify(atelink_mesh.notification_char, self.callback_handler)
-                        await asyncio.sleep(0.3)
-                        await self.client.write_gatt_char(atelink_mesh.notification_char, bytes([0x1]), True)
-                        await asyncio.sleep(0.3)
-                        data3 = await self.client.read_gatt_char(atelink_mesh.notification_char)
-                        logger.info(f"Connected to mesh mac: {mac}")
-                    except Exception as e:
-                        logger.info(f"Unable to connect to mesh mac for notify: {mac} - {e}")
-                        await self.client.disconnect()
-                        self.sk = None
-                        continue
-                    break
-
-        return self.sk is not None
+            if self.scores is not None: self.scores.save()
+            await asyncio.sleep(delay)
+            delay = min(delay*2, 300)
 
     async def update_status(self):
         if self.sk is None:
             logger.info("Attempt re-connect...")
-            if not self.connect():
+            if not await self.connect():
                 return False
 
         ok=False
         for trycount in range(0,3):
             if ok:
                 break            
+            link=self.links[0] if self.links else None
             try:
+                if link is not None: link.notified.clear()
                 await self.client.write_gatt_char(atelink_mesh.notification_char,bytes([0x1]),True)
-                await asyncio.sleep(0.3)
+                if link is not None:
+                    await self._wait_notified(link)
+                else:
+                    await asyncio.sleep(0.3)
                 data3 = await self.client.read_gatt_char(atelink_mesh.notification_char)
                 ok=True
-            except:
+            except Exception:
                 logger.info("update_status - Unable to connect to send to mesh, retry...")
+                status_requests_total.labels(self.name, 'retry').inc()
+                if link is not None and self._drop_link(link):
+                    # another link took over as primary
+                    continue
                 try2=0
                 connected=False
                 while not connected and try2<3:
-                    self.meshmacs[self.currentmac]+=1
+                    if self.currentmac is not None:
+                        self.meshmacs[self.currentmac]+=1
                     self.currentmac=None
                     await asyncio.sleep(0.1)
                     logger.info("Disconnect...")
@@ -345,19 +960,19 @@ class atelink_mesh:
                     connected=await self.connect()
                     try2+=1
                 if not connected:
+                    status_requests_total.labels(self.name, 'failed').inc()
+                    self._links_lost.inc()
+                    self.link_lost.set()
                     return False
+        if ok: status_requests_total.labels(self.name, 'ok').inc()
         return ok
 
     @property
     def online(self):
         return self.client is not None and self.sk is not None and self.macdata is not None
 
-    async def send_packet(self,target, command, data):
-        if not self.online:
-            if not await self.connect():
-                return False
-
-        packet = [0] * 20
+    def _build_packet(self, target, command, data, crypto=None):
+        packet = bytearray(20)
         packet[0] = self.packet_count & 0xff
         packet[1] = self.packet_count >> 8 & 0xff
         packet[5] = target & 0xff
@@ -365,64 +980,282 @@ class atelink_mesh:
         packet[7] = command
         packet[8] = self.vendor & 0xff
         packet[9] = (self.vendor >> 8) & 0xff
-        for i in range(len(data)):
-            packet[10 + i] = data[i]
-        enc_packet = encrypt_packet(self.sk, self.macdata, packet)
+        packet[10:10+len(data)] = bytes(data)
         self.packet_count += 1
         if self.packet_count > 65535:
             self.packet_count = 1
+        return (crypto if crypto is not None else self.crypto).encrypt_packet(packet)
 
-        for trycount in range(0,3):
+    async def send_packet(self,target, command, data):
+        return await self.send_packets(target, [(command, data)]) == 1
+
+    async def send_packets(self, target, commands):
+        # Write a batch of (command, data) to one target through the pipeline of the least
+        # busy link, with a single online check and one reconnect/retry decision for the
+        # whole batch.  A failed link hands the rest of the batch to another live link;
+        # only when none is left is the mesh reconnected.
+        # Returns how many of the commands were written (in order - a packet after a
+        # failed one is sent again even if its own write went through).
+        if not self.online:
+            if not await self.connect():
+                return 0
+
+        sent=0
+        trycount=0
+        while sent<len(commands) and trycount<3:
+            link=self._pick_link() if self.links else None
+            if link is None:
+                if not await self.connect():
+                    break
+                continue
+            link.busy+=1
             try:
-                await self.client.write_gatt_char(network.control_char,bytes(enc_packet))
-            except:
-                logger.info(f"send_packet - Unable to connect to send to mesh")
-                if trycount<2:
-                    self.meshmacs[self.currentmac]+=1
-                    self.currentmac=None
+                # packets are numbered and encrypted for the link they are queued on, so a
+                # retry uses the new session key
+                futures=[link.pipeline.put(bytes(self._build_packet(target,command,data,link.crypto))) for (command,data) in commands[sent:]]
+                results=await asyncio.gather(*futures,return_exceptions=True)
+                written=next((i for i,result in enumerate(results) if isinstance(result,BaseException)),len(results))
+                self._packets_sent.inc(written)
+                link.sent+=written
+                sent+=written
+                if written<len(results):
+                    raise results[written]
+                now=asyncio.get_running_loop().time()
+                self._expire_echoes(now)
+                self._expect_echo(target,link,now)
+            except Exception:
+                logger.info(f"send_packets - Unable to connect to send to mesh via {link.mac}")
+                if self._drop_link(link):
+                    continue
+                trycount+=1
+                if trycount<3:
+                    self._send_retries.inc()
                     await asyncio.sleep(0.1)
-                    await self.disconnect()
+                    if self._connecting is None or self._connecting.done():
+                        await self.disconnect()
                     await asyncio.sleep(0.1)
-                    await self.connect()
-                else:
-                    return False
-            break
-        return True
+                    if not await self.connect():
+                        break
+            finally:
+                link.busy-=1
+        if sent<len(commands):
+            self._links_lost.inc()
+            self.link_lost.set()
+        return sent
 
 class network(atelink_mesh):
 
     devicestatus=namedtuple('DeviceStatus',['name','id','brightness','rgb','red','green','blue','color_temp'])
+    # notification headers remembered to discard copies
+    SEEN=256
 
     def __init__(self,meshmacs, name, password,usebtlib=None,**kwargs):
         self.callback = kwargs.get('callback',None)
-        return atelink_mesh.__init__(self, 0x0211,meshmacs, name, password,usebtlib)
-
-    async def callback_handler(self, sender, data):
-        if self.callback is None: return
-        data=list(data)
+        self.devices = {}
+        self.groups = {}
+        # mesh device id -> device
+        self.ids = {}
+        self._groupaddresses = None
+        # last reported status slot per mesh device id, packed as
+        # 0x1000000 | online<<16 | brightness<<8 | color temperature or rgb.
+        # 0 means no report since mark_offline()/invalidate().
+        self.states = array('I', [0]) * 256
+        # event loop time of the last report per mesh device id (0: none yet)
+        self.lastseen = array('d', [0.0]) * 256
+        self._expected = set()
+        self._sweepdone = None
+        self._notifications = notifications_total.labels(name)
+        self._duplicates = notification_duplicates_total.labels(name)
+        self._status_queries = status_queries_total.labels(name)
+        # Headers (sequence number and source, sent in the clear) of the last SEEN
+        # notifications, in arrival order and as a set.  The mesh relays a status frame
+        # through several nodes, and with several links each copy arrives through each.
+        self._seen = set()
+        self._seenorder = deque()
+        atelink_mesh.__init__(self, 0x0211,meshmacs, name, password,usebtlib,kwargs.get('rate',None),kwargs.get('race',None),kwargs.get('scores',None),kwargs.get('btoptions',None),kwargs.get('links',None),kwargs.get('pacing',None),kwargs.get('window',None))
+        self.transitions = transition_engine(self)
+
+    async def callback_handler(self, sender, data, link=None):
+        # Status slots are compared with the state table first; a slot equal to the last
+        # report only ticks off a running status sweep.  Changes are decoded into the
+        # device and passed on to the callback.
+        self._notifications.inc()
         if len(data)<19: return
-        data=decrypt_packet(self.sk,self.macdata,data)
+        # copies are dropped before they are decrypted
+        header=bytes(data[0:5])
+        if header in self._seen:
+            self._duplicates.inc()
+            return
+        if len(self._seenorder)>=network.SEEN:
+            self._seen.discard(self._seenorder.popleft())
+        self._seenorder.append(header)
+        self._seen.add(header)
+        data=(link.crypto if link is not None else self.crypto).decrypt_packet(bytearray(data))
+        if data[7] == 0xdb:
+            self._status_reply(data)
+            return
         if data[7] != 0xdc:
             return
 
-        responses = data[10:18]
-        for i in (0, 4):
-            response = responses[i:i+4]
-            if response[1]==0: continue
-            id = response[0]
-            brightness = response[2]
+        received=asyncio.get_running_loop().time()
+        for i in (10, 14):
+            if data[i+1]==0: continue
+            id = data[i]
+            self.lastseen[id] = received
+            if id in self._echoes:
+                self._echoed(id, received)
+            if self._expected:
+                self._expected.discard(id)
+                if not self._expected:
+                    self._sweepdone.set()
+            state = 0x1000000 | data[i+1]<<16 | data[i+2]<<8 | data[i+3]
+            if self.states[id]==state: continue
+            self.states[id]=state
+
+            device = self.ids.get(id)
+            if device is None:
+                logger.debug(f"status from unknown device id {id} on {self.name}")
+                continue
+            brightness = data[i+2]
             (red,green,blue)=(0,0,0)
             color_temp=0
             if brightness >= 128:
                     brightness = brightness - 128
-                    red = int(((response[3] & 0xe0) >> 5) * 255 / 7)
-                    green = int(((response[3] & 0x1c) >> 2) * 255 / 7)
-                    blue = int((response[3] & 0x3) * 255 / 3)
+                    red = int(((data[i+3] & 0xe0) >> 5) * 255 / 7)
+                    green = int(((data[i+3] & 0x1c) >> 2) * 255 / 7)
+                    blue = int((data[i+3] & 0x3) * 255 / 3)
                     rgb = True
             else:
-                color_temp = response[3]
+                color_temp = data[i+3]
                 rgb = False
-            await self.callback(network.devicestatus(self.name,id,brightness,rgb,red,green,blue,color_temp))
+            device.online = True
+            device.brightness = brightness
+            device.red = red
+            device.green = green
+            device.blue = blue
+            device.color_temp = color_temp
+            if self.callback is not None:
+                await self.callback(network.devicestatus(self.name,id,brightness,rgb,red,green,blue,color_temp))
+
+    def _status_reply(self, data):
+        # 0xdb answer to a 0xda status request, from the device in the source address.  It
+        # only shows the device is up - its state is not decoded here (a changed state
+        # comes as a 0xdc notification).
+        id = int.from_bytes(data[3:5], 'little')
+        if not 0 <= id < len(self.lastseen): return
+        received = asyncio.get_running_loop().time()
+        self.lastseen[id] = received
+        if id in self._echoes:
+            self._echoed(id, received)
+        if self._expected:
+            self._expected.discard(id)
+            if not self._expected:
+                self._sweepdone.set()
+
+    def duplicate_ratio(self):
+        # share of the notifications received that were discarded as copies
+        received=self._notifications.value
+        return self._duplicates.value/received if received else 0.0
+
+    def _echo_ids(self, target):
+        # devices answer a command with their status - groups are not timed
+        device = self.ids.get(target)
+        return (target,) if device is not None and device.online else ()
+
+    def add_device(self, devicename, newdevice):
+        self.devices[devicename] = newdevice
+        self.ids[newdevice.id] = newdevice
+        self._groupaddresses = None
+
+    def add_group(self, groupname, newgroup):
+        self.groups[groupname] = newgroup
+        self._groupaddresses = None
+
+    def group_addresses(self):
+        # (member ids, address) of the broadcast address and every group, largest first
+        if self._groupaddresses is None:
+            addresses = [(frozenset(self.ids), group.BROADCAST)]
+            addresses += [(frozenset(member.id for member in newgroup.members), newgroup.id) for newgroup in self.groups.values() if newgroup.id != group.BROADCAST]
+            self._groupaddresses = sorted(addresses, key=lambda entry: -len(entry[0]))
+        return self._groupaddresses
+
+    def invalidate(self, id):
+        # the next report from this device is applied even if it repeats the last one
+        if 0 <= id < len(self.states):
+            self.states[id] = 0
+
+    def mark_offline(self):
+        # devices count as offline until they report again
+        self.states = array('I', [0]) * 256
+        for device in self.devices.values():
+            device.online = False
+
+    def expect_status(self, ids=None):
+        # Arm a status sweep before requesting status: wait_status() completes as soon as
+        # every id (default: all devices of this mesh) has reported.
+        self._expected = set(ids) if ids is not None else {device.id for device in self.devices.values()}
+        self._sweepdone = asyncio.Event()
+        if not self._expected:
+            self._sweepdone.set()
+
+    async def wait_status(self, timeout):
+        if self._sweepdone is None: return True
+        try:
+            await asyncio.wait_for(self._sweepdone.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.debug(f"status sweep of {self.name} timed out, no reply from: {sorted(self._expected)}")
+            self._expected = set()
+            return False
+        return True
+
+    async def status_sweep(self, timeout):
+        # request a status dump and wait until every device replied or timeout seconds passed
+        self.expect_status()
+        if not await self.update_status():
+            self._expected = set()
+            return False
+        await self.wait_status(timeout)
+        return True
+
+    def stale(self, age):
+        # ids of devices that have not reported for age seconds (ids that do not fit in a
+        # mesh status slot never report)
+        since = asyncio.get_running_loop().time()-age
+        return [id for id in self.ids if 0 <= id < len(self.lastseen) and self.lastseen[id] <= since]
+
+    async def refresh(self, timeout, age, full_ratio):
+        # Periodic status refresh.  Only devices that have not reported for age seconds are
+        # asked, each with a 0xda status request of its own, and those that stay silent
+        # for timeout seconds go offline.  A request and a reply per device costs about
+        # what a full sweep (every device, two per notification) costs once a quarter of
+        # them are stale, so past full_ratio of stale devices the whole mesh is swept.
+        # The 0xdb reply carries no state we decode, so a stale device that is offline
+        # can only come back through a full sweep as well.
+        # Returns False if the mesh could not be reached.
+        stale = self.stale(age)
+        if not stale:
+            status_refreshes_total.labels(self.name, 'none').inc()
+            return True
+        if len(stale) > full_ratio*len(self.ids) or any(not self.ids[id].online for id in stale):
+            status_refreshes_total.labels(self.name, 'full').inc()
+            self.mark_offline()
+            return await self.status_sweep(timeout)
+
+        status_refreshes_total.labels(self.name, 'targeted').inc()
+        logger.debug(f"refresh of {self.name}: {len(stale)} of {len(self.ids)} devices stale")
+        started = asyncio.get_running_loop().time()
+        self.expect_status(stale)
+        self._status_queries.inc(len(stale))
+        written = await asyncio.gather(*(self.scheduler.submit(id, 'status', 0xda, []) for id in stale))
+        if not any(written):
+            self._expected = set()
+            return False
+        await self.wait_status(timeout)
+        for id in stale:
+            if self.lastseen[id] < started:
+                self.states[id] = 0
+                self.ids[id].online = False
+        return True
 
 class device:
     #from: https://github.com/nikshriv/cync_lights/blob/main/custom_components/cync_lights/cync_hub.py
@@ -457,32 +1290,61 @@ class device:
         self._is_plug=None
         self.reported_temp = 0
 
-    async def set_temperature(self, color_temp):
-        if not self.online: return False
-        if await self.network.send_packet(self.id, 0xe2, [0x05, color_temp]):
-            self.color_temp = color_temp
-            return True
-        return False
+    # set_* queue the command on the network scheduler and return a future resolving
+    # to True once it was written - await it, or fire and forget
+    def set_temperature(self, color_temp):
+        if not self.online: return completed(False)
+        return self.network.scheduler.submit(self.id, 'color_temp', 0xe2, [0x05, color_temp], functools.partial(self._update, color_temp=color_temp))
+
+    def set_rgb(self, red, green, blue):
+        if not self.online: return completed(False)
+        return self.network.scheduler.submit(self.id, 'rgb', 0xe2, [0x04, red, green, blue], functools.partial(self._update, red=red, green=green, blue=blue))
+
+    def set_brightness(self, brightness):
+        if not self.online: return completed(False)
+        return self.network.scheduler.submit(self.id, 'brightness', 0xd2, [brightness], functools.partial(self._update, brightness=brightness))
+
+    def set_power(self, power):
+        if not self.online: return completed(False)
+        on_sent=None if power else functools.partial(self._update, brightness=0)
+        return self.network.scheduler.submit(self.id, 'power', 0xd0, [int(power)], on_sent)
+
+    def apply_state(self, power=None, brightness=None, color_temp=None, rgb=None):
+        # Plan the fewest opcodes for a composite state change and queue them as one
+        # batch.  Values already equal to the cached state are skipped.  Power off is
+        # always sent: a power on does not change the cache until the device reports, so
+        # an off right after it would otherwise look redundant.  Power on is skipped only
+        # when a brightness above 0 is sent along to a device that is already on.
+        if not self.online: return completed(False)
+        ops=[]
+        if power is not None and not power:
+            ops.append(('power', 0xd0, [0], functools.partial(self._update, brightness=0)))
+            return self.network.scheduler.submit_batch(self.id, ops)
+
+        if power and not (brightness and self._all(lambda d: d.brightness>0)):
+            ops.append(('power', 0xd0, [1], None))
+        if brightness is not None and not self._all(lambda d: d.brightness==brightness):
+            ops.append(('brightness', 0xd2, [brightness], functools.partial(self._update, brightness=brightness)))
+        if color_temp is not None and not self._all(lambda d: d.color_temp==color_temp):
+            ops.append(('color_temp', 0xe2, [0x05, color_temp], functools.partial(self._update, color_temp=color_temp)))
+        if rgb is not None and not self._all(lambda d: (d.red,d.green,d.blue)==tuple(rgb)):
+            (red,green,blue)=rgb
+            ops.append(('rgb', 0xe2, [0x04, red, green, blue], functools.partial(self._update, red=red, green=green, blue=blue)))
+        return self.network.scheduler.submit_batch(self.id, ops)
+
+    def _all(self, check):
+        return check(self)
+
+    def _update(self, **attrs):
+        for attr,value in attrs.items():
+            setattr(self,attr,value)
+        # the cache now holds the commanded value - let the device's next report overwrite it
+        if self.network is not None:
+            self.network.invalidate(self.id)
 
-    async def set_rgb(self, red, green, blue):
-        if not self.online: return False
-        if await self.network.send_packet(self.id, 0xe2, [0x04, red, green, blue]):
-            self.red = red
-            self.green = green
-            self.blue = blue
-            return True
-        return False
-
-    async def set_brightness(self, brightness):
-        if not self.online: return False
-        if await self.network.send_packet(self.id, 0xd2, [brightness]):
-            self.brightness = brightness
-            return True
-        return False
-
-    async def set_power(self, power):
-        if not self.online: return False
-        return await self.network.send_packet(self.id, 0xd0, [int(power)])
+    @property
+    def unique_id(self):
+        return self.mac
 
     @property
     def is_plug(self):
@@ -515,3 +1377,85 @@ class device:
     @supports_temperature.setter
     def supports_temperature(self,value):
         self._supports_temperature=value
+
+class group(device):
+    # A Telink group (0x8000 | group number) or the broadcast address (0xffff).  Commands
+    # go out as a single mesh packet to the group address and then update the cached
+    # state of every member, so a whole room changes in one airtime slot.
+    BROADCAST=0xffff
+
+    def __init__(self, mesh_network, name, groupid, members, address=None):
+        self.network = mesh_network
+        self.name = name
+        self.groupid = groupid
+        self.id = address if address is not None else 0x8000 | groupid
+        self.mac = None
+        self.type = None
+        self.members = members
+        self._supports_rgb=None
+        self._supports_temperature=None
+        self._is_plug=None
+
+    def _all(self, check):
+        return all(check(member) for member in self.members)
+
+    def _update(self, **attrs):
+        for member in self.members:
+            member._update(**attrs)
+
+    @property
+    def unique_id(self):
+        return f"{self.network.name}_group{self.groupid}"
+
+    @property
+    def online(self):
+        return any(member.online for member in self.members)
+
+    @online.setter
+    def online(self,value):
+        # availability follows the members
+        pass
+
+    @property
+    def _state_member(self):
+        # group state is reported as that of its brightest online member
+        online=[member for member in self.members if member.online]
+        if not online: return None
+        return max(online, key=lambda member: member.brightness)
+
+    def _member_attr(self, attr):
+        member=self._state_member
+        return getattr(member,attr) if member is not None else 0
+
+    brightness=property(lambda self: self._member_attr('brightness'))
+    color_temp=property(lambda self: self._member_attr('color_temp'))
+    red=property(lambda self: self._member_attr('red'))
+    green=property(lambda self: self._member_attr('green'))
+    blue=property(lambda self: self._member_attr('blue'))
+
+    @property
+    def is_plug(self):
+        if self._is_plug is not None: return self._is_plug
+        return len(self.members)>0 and all(member.is_plug for member in self.members)
+
+    @is_plug.setter
+    def is_plug(self,value):
+        self._is_plug=value
+
+    @property
+    def supports_rgb(self):
+        if self._supports_rgb is not None: return self._supports_rgb
+        return any(member.supports_rgb for member in self.members)
+
+    @supports_rgb.setter
+    def supports_rgb(self,value):
+        self._supports_rgb=value
+
+    @property
+    def supports_temperature(self):
+        if self._supports_temperature is not None: return self._supports_temperature
+        return any(member.supports_temperature for member in self.members)
+
+    @supports_temperature.setter
+    def supports_temperature(self,value):
+        self._supports_temperature=value
@@ -0,0 +1,210 @@
+import asyncio
+import bisect
+import logging
+import time
+
+logger=logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+# Counters, gauges and histograms for the bridge, exported in the Prometheus text
+# format (serve) and as a JSON snapshot.  Hot paths hold on to a labelled child,
+# e.g. self._sent=packets_sent.labels(meshname), so recording a sample is one
+# attribute update.  Values that already live elsewhere (queue depths, scheduler
+# stats, node health) are copied in by collectors just before each export.
+
+DEFAULT_BUCKETS=(0.001,0.0025,0.005,0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5,10,30,60)
+
+class _value(object):
+    __slots__=('value',)
+
+    def __init__(self):
+        self.value=0
+
+    def inc(self, amount=1):
+        self.value+=amount
+
+    def set(self, value):
+        self.value=value
+
+class _histogram_value(object):
+    __slots__=('buckets','counts','sum','count')
+
+    def __init__(self, buckets):
+        self.buckets=buckets
+        # one count per bucket plus +Inf, made cumulative on export
+        self.counts=[0]*(len(buckets)+1)
+        self.sum=0.0
+        self.count=0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets,value)]+=1
+        self.sum+=value
+        self.count+=1
+
+class metric(object):
+    kind='untyped'
+
+    def __init__(self, name, help, labelnames=()):
+        self.name=name
+        self.help=help
+        self.labelnames=tuple(labelnames)
+        self.children={}
+
+    def _new_child(self):
+        return _value()
+
+    def labels(self, *values):
+        values=tuple(str(value) for value in values)
+        child=self.children.get(values)
+        if child is None:
+            if len(values)!=len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}")
+            child=self.children[values]=self._new_child()
+        return child
+
+    def remove(self, *values):
+        self.children.pop(tuple(str(value) for value in values),None)
+
+    def _labelstr(self, values, extra=None):
+        pairs=list(zip(self.labelnames,values))
+        if extra is not None: pairs.append(extra)
+        if not pairs: return ''
+        return '{'+','.join(f'{name}="{_escape(value)}"' for name,value in pairs)+'}'
+
+    def prometheus(self):
+        lines=[f'# HELP {self.name} {self.help}',f'# TYPE {self.name} {self.kind}']
+        for values,child in self.children.items():
+            lines.append(f'{self.name}{self._labelstr(values)} {_number(child.value)}')
+        return lines
+
+    def snapshot(self):
+        if not self.labelnames:
+            return self.children[()].value if () in self.children else 0
+        return {'/'.join(values): child.value for values,child in self.children.items()}
+
+class counter(metric):
+    kind='counter'
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+class gauge(metric):
+    kind='gauge'
+
+    def set(self, value):
+        self.labels().set(value)
+
+class histogram(metric):
+    kind='histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        metric.__init__(self, name, help, labelnames)
+        self.buckets=tuple(buckets)
+
+    def _new_child(self):
+        return _histogram_value(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def prometheus(self):
+        lines=[f'# HELP {self.name} {self.help}',f'# TYPE {self.name} {self.kind}']
+        for values,child in self.children.items():
+            cumulative=0
+            for bound,count in zip(self.buckets+(float('inf'),),child.counts):
+                cumulative+=count
+                le='+Inf' if bound==float('inf') else _number(bound)
+                lines.append(f'{self.name}_bucket{self._labelstr(values,("le",le))} {cumulative}')
+            lines.append(f'{self.name}_sum{self._labelstr(values)} {_number(child.sum)}')
+            lines.append(f'{self.name}_count{self._labelstr(values)} {child.count}')
+        return lines
+
+    def snapshot(self):
+        def summary(child):
+            return {'count': child.count, 'sum': round(child.sum,6), 'avg': round(child.sum/child.count,6) if child.count else 0}
+        if not self.labelnames:
+            return summary(self.children[()]) if () in self.children else summary(_histogram_value(self.buckets))
+        return {'/'.join(values): summary(child) for values,child in self.children.items()}
+
+def _escape(value):
+    return value.replace('\\','\\\\').replace('"','\\"').replace('\n','\\n')
+
+def _number(value):
+    if isinstance(value,bool): return str(int(value))
+    if isinstance(value,float) and value.is_integer(): return str(int(value))
+    return str(value)
+
+class registry(object):
+    def __init__(self):
+        self.metrics={}
+        self.collectors=[]
+        self.started=time.time()
+
+    def _get(self, cls, name, help, labelnames, **kwargs):
+        if name in self.metrics:
+            return self.metrics[name]
+        self.metrics[name]=cls(name, help, labelnames, **kwargs)
+        return self.metrics[name]
+
+    def counter(self, name, help, labelnames=()):
+        return self._get(counter, name, help, labelnames)
+
+    def gauge(self, name, help, labelnames=()):
+        return self._get(gauge, name, help, labelnames)
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._get(histogram, name, help, labelnames, buckets=buckets)
+
+    def add_collector(self, collector):
+        # collector() is called before every export to copy current values into gauges
+        self.collectors.append(collector)
+
+    def remove_collector(self, collector):
+        if collector in self.collectors:
+            self.collectors.remove(collector)
+
+    def collect(self):
+        for collector in self.collectors:
+            try:
+                collector()
+            except Exception as e:
+                logger.debug(f"metrics collector failed: {e}")
+
+    def prometheus(self):
+        self.collect()
+        lines=[]
+        for metric in self.metrics.values():
+            lines.extend(metric.prometheus())
+        return '\n'.join(lines)+'\n'
+
+    def snapshot(self):
+        self.collect()
+        result={'time': int(time.time()), 'uptime': int(time.time()-self.started)}
+        for name,metric in self.metrics.items():
+            result[name]=metric.snapshot()
+        return result
+
+    async def serve(self, port, host='127.0.0.1'):
+        # minimal HTTP endpoint for Prometheus scrapes - every GET returns the metrics
+        async def handle(reader, writer):
+            try:
+                request=await asyncio.wait_for(reader.readline(),10)
+                while (await asyncio.wait_for(reader.readline(),10)) not in (b'\r\n',b'\n',b''):
+                    pass
+                if request.startswith(b'GET '):
+                    body=self.prometheus().encode()
+                    writer.write(b'HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n'+f'Content-Length: {len(body)}\r\n\r\n'.encode()+body)
+                else:
+                    writer.write(b'HTTP/1.0 405 Method Not Allowed\r\nContent-Length: 0\r\n\r\n')
+                await writer.drain()
+            except Exception as e:
+                logger.debug(f"metrics request failed: {e}")
+            finally:
+                writer.close()
+
+        server=await asyncio.start_server(handle, host, port)
+        logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+        return server
+
+# process wide registry used by acync and cync2mqtt
+default_registry=registry()
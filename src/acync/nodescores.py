@@ -0,0 +1,62 @@
+import json
+import logging
+import time
+from pathlib import Path
+
+from acync.jsonfile import write_json
+
+logger=logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+class node_scores(object):
+    # Connect latency and failure history per mesh node (by MAC), optionally kept on
+    # disk so the nodes that connected best are tried first after a restart.
+    # Lower score is better: smoothed connect+pair seconds plus a penalty scaled by the
+    # smoothed failure rate.
+    UNKNOWN_LATENCY=10.0
+    FAILURE_PENALTY=30.0
+
+    def __init__(self, path=None, alpha=0.3):
+        self.path=Path(path) if path else None
+        self.alpha=alpha
+        self.nodes={}
+        self._dirty=False
+        if self.path is not None and self.path.exists():
+            try:
+                with self.path.open("rt") as fp:
+                    self.nodes=json.load(fp)
+            except Exception as e:
+                logger.info(f"Unable to load node scores from {self.path}: {e}")
+
+    def _node(self, mac):
+        if mac not in self.nodes:
+            self.nodes[mac]={'latency': None, 'failure_rate': 0.0, 'successes': 0, 'failures': 0, 'last_success': None, 'last_failure': None}
+        self._dirty=True
+        return self.nodes[mac]
+
+    def record_success(self, mac, latency):
+        node=self._node(mac)
+        node['latency']=latency if node['latency'] is None else (1-self.alpha)*node['latency']+self.alpha*latency
+        node['failure_rate']=(1-self.alpha)*node['failure_rate']
+        node['successes']+=1
+        node['last_success']=int(time.time())
+
+    def record_failure(self, mac):
+        node=self._node(mac)
+        node['failure_rate']=(1-self.alpha)*node['failure_rate']+self.alpha
+        node['failures']+=1
+        node['last_failure']=int(time.time())
+
+    def score(self, mac):
+        if mac not in self.nodes: return self.UNKNOWN_LATENCY
+        node=self.nodes[mac]
+        latency=node['latency'] if node['latency'] is not None else self.UNKNOWN_LATENCY
+        return latency+self.FAILURE_PENALTY*node['failure_rate']
+
+    def save(self):
+        if self.path is None or not self._dirty: return
+        try:
+            write_json(self.path,self.nodes,indent=1)
+            self._dirty=False
+        except Exception as e:
+            logger.info(f"Unable to save node scores to {self.path}: {e}")
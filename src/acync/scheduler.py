@@ -0,0 +1,155 @@
+import asyncio
+import logging
+
+logger=logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+def completed(result):
+    # an already finished future - lets callers always await what device.set_* returns
+    future=asyncio.get_running_loop().create_future()
+    future.set_result(result)
+    return future
+
+class command_scheduler(object):
+    # Sits in front of atelink_mesh.send_packet.  Only the latest pending command for
+    # each (target, attribute) is kept - a newer value replaces the queued one in place -
+    # and the queue is drained at a packets-per-second budget: rate, or with adaptive
+    # pacing whatever the mesh links currently take (see mesh.flow_control).  Batches are
+    # not held back by slow writes: up to mesh.lanes() (write_window per link) are in
+    # flight at once.  Batches for the same target never are, so they stay in order.
+    def __init__(self, mesh, rate=None):
+        self.mesh=mesh
+        self.rate=rate if rate else 10
+        self.pending={}
+        self.submitted=0
+        self.sent=0
+        self.coalesced=0
+        self.failed=0
+        self._wakeup=None
+        self._task=None
+        self._next_send=0
+        # target -> (send_packets task in flight, its entries), and the commands they are writing
+        self._inflight={}
+        self._inflight_commands=0
+
+    def submit(self, target, attr, command, data, on_sent=None):
+        future=self._queue(target, attr, command, data, on_sent)
+        self._start()
+        return future
+
+    def submit_batch(self, target, ops):
+        # ops is a list of (attr, command, data, on_sent) for one target.  They are sent
+        # back-to-back in one send_packets call; the future is True when all were written.
+        if not ops: return completed(True)
+        futures=[self._queue(target, *op) for op in ops]
+        self._start()
+        if len(futures)==1: return futures[0]
+
+        result=asyncio.get_running_loop().create_future()
+        def done(gathered):
+            if not result.done():
+                result.set_result(all(gathered.result()))
+        asyncio.gather(*futures).add_done_callback(done)
+        return result
+
+    def _queue(self, target, attr, command, data, on_sent=None):
+        loop=asyncio.get_running_loop()
+        future=loop.create_future()
+        key=(target,attr)
+        self.submitted+=1
+        if key in self.pending:
+            # superseded: the new value goes to the back of the queue, after anything
+            # queued for the target since (e.g. dim, off, on+dim must end on), and the
+            # earlier caller sees the result of the write that replaced it
+            entry=self.pending.pop(key)
+            entry[0:3]=[command,data,on_sent]
+            entry[3].append(future)
+            self.pending[key]=entry
+            self.coalesced+=1
+            logger.debug(f"coalesced command {command:#x} for target {target} ({attr})")
+        else:
+            self.pending[key]=[command,data,on_sent,[future]]
+        return future
+
+    def _start(self):
+        if self._task is None or self._task.done():
+            self._wakeup=asyncio.Event()
+            self._task=asyncio.create_task(self._drain())
+        self._wakeup.set()
+
+    def throughput(self):
+        # packets per second over all links of the mesh
+        return self.mesh.throughput()
+
+    async def _drain(self):
+        loop=asyncio.get_running_loop()
+        while True:
+            target=next((key[0] for key in self.pending if key[0] not in self._inflight),None)
+            if target is None or len(self._inflight)>=self.mesh.lanes():
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            delay=self._next_send-loop.time()
+            if delay>0:
+                await asyncio.sleep(delay)
+                continue
+
+            # pop only after pacing so anything arriving meanwhile is still coalesced;
+            # everything pending for the same target goes out as one batch
+            entries=[self.pending.pop(key) for key in [key for key in self.pending if key[0]==target]]
+            self._next_send=loop.time()+len(entries)/self.throughput()
+            self._inflight_commands+=len(entries)
+            self._inflight[target]=(asyncio.create_task(self._send(target,entries)),entries)
+
+    async def _send(self, target, entries):
+        try:
+            try:
+                sent=await self.mesh.send_packets(target,[(command,data) for (command,data,on_sent,futures) in entries])
+            except Exception as e:
+                logger.info(f"scheduler - send_packets failed: {e}")
+                sent=0
+
+            for i,(command,data,on_sent,futures) in enumerate(entries):
+                ok=i<sent
+                if ok:
+                    self.sent+=1
+                    if on_sent is not None:
+                        on_sent()
+                else:
+                    self.failed+=1
+                for future in futures:
+                    if not future.done():
+                        future.set_result(ok)
+        finally:
+            # cancelled: callers still waiting are told the commands were not sent
+            self._abandon(entries)
+            del self._inflight[target]
+            self._inflight_commands-=len(entries)
+            self._wakeup.set()
+
+    def _abandon(self, entries):
+        for (command,data,on_sent,futures) in entries:
+            for future in futures:
+                if not future.done():
+                    future.set_result(False)
+
+    def stats(self):
+        return {'submitted': self.submitted, 'sent': self.sent, 'coalesced': self.coalesced, 'failed': self.failed, 'pending': len(self.pending)+self._inflight_commands}
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task=None
+        inflight=list(self._inflight.values())
+        for (task,entries) in inflight:
+            task.cancel()
+        await asyncio.gather(*(task for (task,entries) in inflight), return_exceptions=True)
+        # a send cancelled before it started never ran its own cleanup
+        for (task,entries) in inflight:
+            self._abandon(entries)
+        self._inflight.clear()
+        self._inflight_commands=0
+        self._abandon(self.pending.values())
+        self.pending.clear()
@@ -0,0 +1,308 @@
+# In-process simulated Telink mesh, selected with usebtlib: sim
+#
+# sim_mesh holds the state of a set of virtual devices reachable through a set of
+# virtual node MACs.  btle_gatt talks to it through sim_client, which mirrors the bleak
+# client API: the pairing handshake (key_encrypt/generate_sk) is verified and answered,
+# control writes are decrypted and applied, and state changes come back as encrypted
+# 0xdc status notifications after a configurable latency, with optional loss,
+# duplicated (relayed) notifications and node failures.  Control writes can take
+# write_time to return; several may be in progress at once.  With airtime set, control
+# packets take turns on the mesh and packets that would wait longer than backlog are
+# dropped, like a congested mesh.
+
+import asyncio
+import logging
+import os
+import random
+
+from acync.mesh import atelink_mesh,key_encrypt,generate_sk,telink_crypto,_xor
+
+logger=logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+# node mac (upper case, colon separated) -> sim_mesh
+_nodes={}
+
+def lookup(mac):
+    return _nodes.get(mac.upper())
+
+class sim_device(object):
+    def __init__(self, id):
+        self.id=id
+        self.online=True
+        self.on=False
+        self.brightness=100
+        self.rgb=False
+        self.color_temp=50
+        self.red=0
+        self.green=0
+        self.blue=0
+
+    def slot(self):
+        # 4 byte status slot as carried in a 0xdc notification
+        brightness=self.brightness if self.on else 0
+        if self.rgb:
+            return bytes([self.id, 1, brightness+128, (self.red>>5)<<5 | (self.green>>5)<<2 | self.blue>>6])
+        return bytes([self.id, 1, brightness, self.color_temp])
+
+class sim_mesh(object):
+    def __init__(self, name, password, nodes, devices, groups=None, vendor=0x0211, latency=0.02, jitter=0.0,
+                 loss=0.0, duplicate=0.0, connect_time=0.05, connect_failure=0.0, failed_nodes=None, seed=None,
+                 pair_time=0.02, airtime=0.0, backlog=0.5, write_time=0.0):
+        self.name=name
+        self.password=password
+        self.vendor=vendor
+        self.nodes=[mac.upper() for mac in nodes]
+        self.devices={id: sim_device(id) for id in devices}
+        # group address -> member ids
+        self.groups={}
+        for address,members in (groups or {}).items():
+            self.groups[address]=list(members)
+        self.latency=latency
+        self.jitter=jitter
+        self.loss=loss
+        self.duplicate=duplicate
+        self.connect_time=connect_time
+        self.connect_failure=connect_failure
+        self.pair_time=pair_time
+        self.airtime=airtime
+        self.backlog=backlog
+        # seconds until a control write returns (the host side round trip)
+        self.write_time=write_time
+        # when the mesh is done relaying the control packets written so far
+        self.busy_until=0
+        self.failed=set(mac.upper() for mac in (failed_nodes or []))
+        self.random=random.Random(seed)
+        self.clients=set()
+        self.sequence=self.random.randrange(0xffffff)
+        # counters for benchmarks
+        self.commands=0
+        self.notifications=0
+        self.dropped=0
+        # optional hooks for benchmarks: on_command(target, command, data) for every applied
+        # command, on_notify(packet) with the plaintext of every delivered notification
+        self.on_command=None
+        self.on_notify=None
+        for mac in self.nodes:
+            _nodes[mac]=self
+
+    def close(self):
+        for mac in self.nodes:
+            if _nodes.get(mac) is self:
+                del _nodes[mac]
+
+    def fail_node(self, mac):
+        # node goes dark: connections through it drop and new ones fail
+        mac=mac.upper()
+        self.failed.add(mac)
+        for client in list(self.clients):
+            if client.mac==mac:
+                client._drop()
+
+    def restore_node(self, mac):
+        self.failed.discard(mac.upper())
+
+    def targets(self, target):
+        if target==0xffff:
+            return list(self.devices.values())
+        if target & 0x8000:
+            return [self.devices[id] for id in self.groups.get(target,[]) if id in self.devices]
+        return [self.devices[target]] if target in self.devices else []
+
+    def apply(self, target, command, data):
+        self.commands+=1
+        if self.on_command is not None:
+            self.on_command(target, command, data)
+        devices=[device for device in self.targets(target) if device.online]
+        for device in devices:
+            if command==0xd0:
+                device.on=bool(data[0])
+            elif command==0xd2:
+                if data[0]>0:
+                    device.brightness=min(data[0],100)
+                    device.on=True
+                else:
+                    device.on=False
+            elif command==0xe2 and data[0]==0x05:
+                device.rgb=False
+                device.color_temp=data[1]
+            elif command==0xe2 and data[0]==0x04:
+                device.rgb=True
+                (device.red,device.green,device.blue)=data[1:4]
+        # every command is answered with the new status, the 0xda status request with a
+        # 0xdb reply from each device
+        return devices
+
+    def status_packets(self, devices, source=None):
+        # plaintext 0xdc packets, two device slots each, from source or else from the
+        # first device they report on
+        devices=[device for device in devices if device.online]
+        packets=[]
+        for i in range(0,len(devices),2):
+            self.sequence=(self.sequence+1) & 0xffffff
+            packet=bytearray(20)
+            packet[0:3]=self.sequence.to_bytes(3,'little')
+            packet[3:5]=(source if source is not None else devices[i].id).to_bytes(2,'little')
+            packet[7]=0xdc
+            packet[8:10]=self.vendor.to_bytes(2,'little')
+            for j,device in enumerate(devices[i:i+2]):
+                packet[10+4*j:14+4*j]=device.slot()
+            packets.append(packet)
+        return packets
+
+    def status_replies(self, devices):
+        # plaintext 0xdb answers to a 0xda status request, one per device from its own address
+        packets=[]
+        for device in devices:
+            if not device.online: continue
+            self.sequence=(self.sequence+1) & 0xffffff
+            packet=bytearray(20)
+            packet[0:3]=self.sequence.to_bytes(3,'little')
+            packet[3:5]=device.id.to_bytes(2,'little')
+            packet[7]=0xdb
+            packet[8:10]=self.vendor.to_bytes(2,'little')
+            packet[10:13]=device.slot()[1:]
+            packets.append(packet)
+        return packets
+
+    def emit(self, devices, replies=False):
+        # the same mesh packets are relayed to every connected client
+        packets=self.status_replies(devices) if replies else self.status_packets(devices)
+        for client in list(self.clients):
+            client._emit(packets)
+
+class sim_client(object):
+    # bleak-like client for one virtual node
+    def __init__(self, mac, disconnected_callback=None):
+        self.mac=mac.upper()
+        self.mesh=lookup(mac)
+        if self.mesh is None:
+            raise ValueError(f"no simulated mesh node with mac: {mac}")
+        self.source=self.mesh.nodes.index(self.mac)+1
+        self.macdata=list(reversed([int(x,16) for x in self.mac.split(':')]))
+        self.disconnected_callback=disconnected_callback
+        self.is_connected=False
+        self.crypto=None
+        self._pairing=None
+        self._request=None
+        self._pair_ready=0
+        self._notify=None
+        self._tasks=set()
+
+    async def connect(self, timeout=None):
+        await asyncio.sleep(self.mesh.connect_time)
+        if self.mac in self.mesh.failed or self.mesh.random.random()<self.mesh.connect_failure:
+            raise Exception(f"sim: unable to connect to {self.mac}")
+        self.is_connected=True
+        self.mesh.clients.add(self)
+        return True
+
+    async def disconnect(self):
+        self.is_connected=False
+        self.mesh.clients.discard(self)
+        self._notify=None
+        return True
+
+    def _drop(self):
+        self.is_connected=False
+        self.mesh.clients.discard(self)
+        self._notify=None
+        if self.disconnected_callback is not None:
+            self.disconnected_callback(self)
+
+    def _check(self):
+        if not self.is_connected or self.mac in self.mesh.failed:
+            raise Exception(f"sim: {self.mac} not connected")
+
+    async def start_notify(self, uuid, callback):
+        self._check()
+        self._notify=callback
+
+    async def read_gatt_char(self, uuid):
+        self._check()
+        if uuid==atelink_mesh.pairing_char:
+            if self._request is not None and asyncio.get_running_loop().time()<self._pair_ready:
+                # reply not computed yet - still reads as the request
+                return self._request
+            return self._pairing if self._pairing is not None else bytes([0x0e])
+        return bytes([0x01])
+
+    async def write_gatt_char(self, uuid, data, response=False):
+        self._check()
+        data=bytes(data)
+        if uuid==atelink_mesh.pairing_char and data[0]==0x0c:
+            self._pair(data)
+        elif uuid==atelink_mesh.notification_char and data==b'\x01':
+            self._emit(self.mesh.status_packets(list(self.mesh.devices.values()),self.source))
+        elif uuid==atelink_mesh.control_char and self.crypto is not None:
+            if self.mesh.write_time:
+                await asyncio.sleep(self.mesh.write_time)
+                self._check()
+            packet=self._decrypt_command(bytearray(data))
+            if packet is None:
+                logger.debug(f"sim: {self.mac} dropped packet with bad mac")
+                return
+            if not self.mesh.airtime:
+                self._apply(packet)
+                return
+            loop=asyncio.get_running_loop()
+            now=loop.time()
+            start=max(now,self.mesh.busy_until)
+            if start-now>self.mesh.backlog:
+                self.mesh.dropped+=1
+                return
+            self.mesh.busy_until=start+self.mesh.airtime
+            loop.call_later(self.mesh.busy_until-now,self._apply,packet)
+
+    def _apply(self, packet):
+        target=int.from_bytes(packet[5:7],'little')
+        vendor=int.from_bytes(packet[8:10],'little')
+        if vendor!=self.mesh.vendor: return
+        devices=self.mesh.apply(target,packet[7],list(packet[10:]))
+        self.mesh.emit(devices,replies=packet[7]==0xda)
+
+    def _pair(self, data):
+        self._request=data
+        self._pair_ready=asyncio.get_running_loop().time()+self.mesh.pair_time
+        client_random=list(data[1:9])
+        expected=key_encrypt(self.mesh.name,self.mesh.password,client_random+[0]*8)[0:8]
+        if list(data[9:17])!=expected:
+            self._pairing=bytes([0x0e])
+            self.crypto=None
+            return
+        server_random=list(os.urandom(8))
+        self._pairing=bytes([0x0d]+server_random+[0]*8)
+        self.crypto=telink_crypto(generate_sk(self.mesh.name,self.mesh.password,client_random,server_random),self.macdata)
+
+    def _decrypt_command(self, packet):
+        # inverse of telink_crypto.encrypt_packet, checking the 2 byte packet mac
+        header=bytes(packet[0:3])
+        address=bytes(self.macdata)
+        packet[5:20]=_xor(packet[5:20],self.crypto.encrypt(b'\x00'+address[0:4]+b'\x01'+header+bytes(7))[0:15])
+        authenticator=self.crypto.encrypt(address[0:4]+b'\x01'+header+b'\x0f'+bytes(7))
+        mac=self.crypto.encrypt(_xor(authenticator[0:15],packet[5:20])+authenticator[15:16])
+        if mac[0:2]!=bytes(packet[3:5]):
+            return None
+        return packet
+
+    def _emit(self, packets):
+        if self._notify is None or self.crypto is None: return
+        loop=asyncio.get_running_loop()
+        for packet in packets:
+            copies=1
+            if self.mesh.duplicate and self.mesh.random.random()<self.mesh.duplicate:
+                copies=2
+            for copy in range(copies):
+                if self.mesh.loss and self.mesh.random.random()<self.mesh.loss:
+                    continue
+                delay=self.mesh.latency+(self.mesh.random.uniform(0,self.mesh.jitter) if self.mesh.jitter else 0)
+                loop.call_later(delay,self._deliver,self.crypto.decrypt_packet(bytearray(packet)),packet)
+
+    def _deliver(self, packet, plaintext):
+        if self._notify is None: return
+        self.mesh.notifications+=1
+        if self.mesh.on_notify is not None:
+            self.mesh.on_notify(plaintext)
+        task=asyncio.ensure_future(self._notify(atelink_mesh.notification_char,packet))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
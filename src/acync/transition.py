@@ -0,0 +1,215 @@
+import asyncio
+import functools
+import logging
+from acync.scheduler import completed
+
+logger=logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+class transition(object):
+    # One fade of a device or group from its cached state to a target state.  ids are
+    # the mesh device ids it moves; power False ends the fade with the device switched off.
+    def __init__(self, device, ids, start, duration, end, power, future):
+        self.device=device
+        self.ids=ids
+        self.start=start
+        self.duration=duration
+        self.end=end
+        self.power=power
+        self.future=future
+        self.begin={attr: getattr(device,attr) for attr in ('brightness','color_temp')}
+        self.begin['rgb']=(device.red,device.green,device.blue)
+        self.turn_on=power is not False and device.brightness==0
+        if self.turn_on:
+            self.begin['brightness']=0
+        # values already sent - the device is at its begin state, except when switched on
+        self.last={attr: value for attr,value in self.begin.items() if not (self.turn_on and attr=='brightness')}
+
+    def values(self, now):
+        # the state at time now, and whether the fade is finished
+        progress=min(1.0,(now-self.start)/self.duration) if self.duration>0 else 1.0
+        values={}
+        for attr,end in self.end.items():
+            begin=self.begin[attr]
+            if attr=='rgb':
+                values[attr]=tuple(int(round(b+(e-b)*progress)) for b,e in zip(begin,end))
+            else:
+                values[attr]=int(round(begin+(end-begin)*progress))
+        if 'brightness' in values:
+            values['brightness']=max(1,values['brightness'])
+        finished=progress>=1.0
+        if finished and self.power is False:
+            # a fade out ends with power off rather than brightness 0
+            del values['brightness']
+            values['power']=0
+        return (values,finished)
+
+class transition_engine(object):
+    # Fades for any number of devices of one network.  Every frame the next value of
+    # each running fade is worked out, devices that move in lockstep (same attribute,
+    # same value) are sent one packet to a group address covering exactly them - or the
+    # broadcast address - and the rest one packet each.  Frames go through the network's
+    # command scheduler, so a frame not yet sent is replaced by the next one, and the
+    # frame rate drops as needed to keep the frames within share of its packet budget.
+    #
+    # Home assistant sends a fade of a light group as one command per light, a few ms
+    # apart.  A fade equal to one started less than align seconds earlier takes over its
+    # start time so the two stay in lockstep.
+    def __init__(self, network, frame_interval=0.1, share=0.8, align=0.5):
+        self.network=network
+        self.frame_interval=frame_interval
+        self.share=share
+        self.align=align
+        self.transitions={}
+        self.frames=0
+        self.packets=0
+        self._task=None
+
+    def start(self, device, duration, power=None, brightness=None, color_temp=None, rgb=None):
+        # Fade device to the given state over duration seconds.  A running fade of the
+        # device, or of a group sharing members with it, is replaced.  Returns a future
+        # resolving to True when the fade finished or False if it was replaced.
+        if not device.online:
+            return completed(False)
+        loop=asyncio.get_running_loop()
+        ids=frozenset(member.id for member in device.members) if hasattr(device,'members') else frozenset([device.id])
+        self.cancel(device,ids)
+
+        end={}
+        if brightness is not None:
+            end['brightness']=brightness
+        elif power is False:
+            end['brightness']=0
+        elif power and device.brightness==0:
+            # fade in to the brightness the device had before it was switched off is not
+            # known to the bridge - fade to full
+            end['brightness']=100
+        if color_temp is not None:
+            end['color_temp']=color_temp
+        if rgb is not None:
+            end['rgb']=tuple(rgb)
+        if power is False and device.brightness==0:
+            return completed(True)
+
+        future=loop.create_future()
+        now=loop.time()
+        newfade=transition(device,ids,now,duration,end,power,future)
+        for running in self.transitions.values():
+            if now-running.start<self.align and (running.begin,running.end,running.duration,running.power)==(newfade.begin,newfade.end,newfade.duration,newfade.power):
+                newfade.start=running.start
+                break
+        self.transitions[device]=newfade
+        if self._task is None or self._task.done():
+            self._task=asyncio.create_task(self._run())
+        return future
+
+    def cancel(self, device, ids=None):
+        # stop fades of device and of anything overlapping it, leaving the last frame in place
+        if ids is None:
+            ids=frozenset(member.id for member in device.members) if hasattr(device,'members') else frozenset([device.id])
+        for other,running in list(self.transitions.items()):
+            if other is device or running.ids & ids:
+                del self.transitions[other]
+                if not running.future.done():
+                    running.future.set_result(False)
+
+    def _settled(self, device, attr, value):
+        # the device's cached state already is value, so sending it value changes nothing
+        if attr=='power':
+            return (device.brightness>0)==bool(value)
+        if attr=='rgb':
+            return (device.red,device.green,device.blue)==value
+        return getattr(device,attr)==value
+
+    def _cover(self, ids, attr, value):
+        # Group addresses (largest first) whose members all need value or are online and
+        # already at value, then single devices for the rest
+        remaining=set(ids)
+        settled=None
+        targets=[]
+        for (members,address) in self.network.group_addresses():
+            if len(members)<2 or not members&remaining: continue
+            if not members<=remaining:
+                if settled is None:
+                    settled={id for id,device in self.network.ids.items() if id not in ids and device.online and self._settled(device,attr,value)}
+                if not members<=remaining|settled: continue
+            targets.append((address,members&remaining))
+            remaining-=members
+        targets.extend((id,frozenset([id])) for id in sorted(remaining))
+        return targets
+
+    def _sent(self, ids, attr, value):
+        for id in ids:
+            device=self.network.ids.get(id)
+            if device is None: continue
+            if attr=='rgb':
+                device._update(red=value[0],green=value[1],blue=value[2])
+            elif attr=='power':
+                if not value:
+                    device._update(brightness=0)
+            else:
+                device._update(**{attr: value})
+
+    def frame(self, now):
+        # Submit the next frame of every running fade.  Returns the number of packets.
+        lockstep={}
+        finished=[]
+        for device,running in list(self.transitions.items()):
+            (values,done)=running.values(now)
+            if running.turn_on:
+                # switched on after its first brightness so it does not flash to full
+                running.turn_on=False
+                values['power']=1
+            for attr,value in values.items():
+                if running.last.get(attr)==value: continue
+                running.last[attr]=value
+                lockstep.setdefault((attr,value),set()).update(running.ids)
+            if done:
+                finished.append(device)
+
+        packets=0
+        # brightness before power so a device switched on starts dim
+        order={'brightness': 0, 'color_temp': 1, 'rgb': 2, 'power': 3}
+        for (attr,value),ids in sorted(lockstep.items(),key=lambda item: order[item[0][0]]):
+            for (target,members) in self._cover(ids,attr,value):
+                on_sent=functools.partial(self._sent,members,attr,value)
+                if attr=='brightness':
+                    self.network.scheduler.submit(target,'brightness',0xd2,[value],on_sent)
+                elif attr=='color_temp':
+                    self.network.scheduler.submit(target,'color_temp',0xe2,[0x05,value],on_sent)
+                elif attr=='rgb':
+                    self.network.scheduler.submit(target,'rgb',0xe2,[0x04,*value],on_sent)
+                else:
+                    self.network.scheduler.submit(target,'power',0xd0,[value],on_sent)
+                packets+=1
+
+        for device in finished:
+            running=self.transitions.pop(device)
+            if not running.future.done():
+                running.future.set_result(True)
+        self.frames+=1
+        self.packets+=packets
+        return packets
+
+    async def _run(self):
+        loop=asyncio.get_running_loop()
+        while self.transitions:
+            now=loop.time()
+            packets=self.frame(now)
+            if not self.transitions: break
+            # frames must fit in share of the scheduler's packets per second, but the
+            # last frame of a fade is not put off past its end
+            delay=packets/(self.network.scheduler.throughput()*self.share)
+            end=min(running.start+running.duration for running in self.transitions.values())-now
+            await asyncio.sleep(max(self.frame_interval,min(delay,end)))
+
+    def stats(self):
+        return {'running': len(self.transitions), 'frames': self.frames, 'packets': self.packets}
+
+    async def close(self):
+        for device in list(self.transitions):
+            self.cancel(device)
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task=None